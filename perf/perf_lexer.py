@@ -0,0 +1,26 @@
+"""Lexer throughput on multi-megabyte inputs
+
+    python perf/perf_lexer.py [megabytes]
+"""
+
+import io
+import sys
+import time
+
+from smx import Smx
+
+MB = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+chunk = """
+<tr><td class="name">some literal text, with (parens) and "quotes"</td>
+    <td>%add(1,%add(2, 3))</td><td>%version%</td><td>%%done</td></tr>
+"""
+
+text = chunk * int(MB * 1024 * 1024 / len(chunk))
+
+ctx = Smx()
+t = time.monotonic()
+ctx.expand_io(io.StringIO(text), io.StringIO())
+secs = time.monotonic() - t
+
+print("%.1f MB in %.2fs, %.1f MB/s" % (len(text) / 1024 / 1024, secs, len(text) / 1024 / 1024 / secs))
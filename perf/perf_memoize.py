@@ -0,0 +1,57 @@
+"""Per call overhead of memoize on cache hits
+
+    python perf/perf_memoize.py
+"""
+
+import timeit
+
+from smx.memoize import memoize
+
+N = 200000
+
+
+@memoize
+def pos(a, b):
+    return a
+
+
+@memoize
+def kw(a, b=None):
+    return a
+
+
+@memoize(maxsize=100)
+def lru(a, b):
+    return a
+
+
+@memoize(expire_secs=3600)
+def ttl(a, b):
+    return a
+
+
+class Cls:
+    @memoize
+    def meth(self, a):
+        return a
+
+
+def plain(a, b):
+    return a
+
+
+obj = Cls()
+
+tests = {
+    "plain function": lambda: plain(1, 2),
+    "f(1, 2)": lambda: pos(1, 2),
+    "f(1, b=2)": lambda: kw(1, b=2),
+    "obj.meth(1)": lambda: obj.meth(1),
+    "maxsize f(1, 2)": lambda: lru(1, 2),
+    "ttl f(1, 2)": lambda: ttl(1, 2),
+}
+
+for name, test in tests.items():
+    test()
+    secs = min(timeit.repeat(test, number=N, repeat=5))
+    print("%-16s %.2fus" % (name, secs / N * 1e6))
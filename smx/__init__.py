@@ -1,6 +1,7 @@
 """Simple python macro expansion"""
 
 from .smx import Smx, __version__
+from .template import Template
 from .wsgi import SmxWsgi
 
 # for command line use of servers
@@ -1,28 +1,561 @@
 import os
+import io
+import sys
 import time
+import pickle
+import sqlite3
+import asyncio
+import inspect
 import functools
+import contextlib
 import logging
-from typing import Callable, Any, Dict, cast
+import weakref
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from typing import Callable, Any, Dict, Deque, NamedTuple, Tuple, cast
 
 log = logging.getLogger(__name__)
 
+# max expired entries removed by each call to a memoized function
+SWEEP_LIMIT = 8
+
+# sqlite 3.24 added upserts, older versions update then insert
+_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# threads refreshing stale results, see memoize(stale_secs=...)
+REFRESH_WORKERS = 4
+_refresh_executor = None
+_refresh_lock = threading.Lock()
+
+
+def _refresh_pool() -> ThreadPoolExecutor:
+    global _refresh_executor
+    if _refresh_executor is None:
+        with _refresh_lock:
+            if _refresh_executor is None:
+                _refresh_executor = ThreadPoolExecutor(REFRESH_WORKERS, thread_name_prefix="memoize-refresh")
+    return _refresh_executor
+
+
+class _KwdMark:
+    """ Separates positional from keyword arguments in cache keys """
+
+    def __repr__(self):
+        return "_KWD_MARK"
+
+    def __reduce__(self):
+        # pickles by reference, so keys stay equal across processes
+        return "_KWD_MARK"
+
+
+_KWD_MARK = _KwdMark()
+
+
+class _ScopeMark:
+    """ Marks keys stored under a SqliteCache scope """
+
+    def __repr__(self):
+        return "_SCOPE_MARK"
+
+    def __reduce__(self):
+        return "_SCOPE_MARK"
+
+
+_SCOPE_MARK = _ScopeMark()
+
+
+def make_key(args, kwargs, typed=False):
+    """ Default cache key: the args tuple itself when there are no kwargs """
+    key = args
+    if kwargs:
+        items = tuple(sorted(kwargs.items()))
+        key += (_KWD_MARK,) + items
+    if typed:
+        key += tuple(type(v) for v in args)
+        if kwargs:
+            key += tuple(type(v) for _, v in items)
+    return key
+
+
+def _ordered(items):
+    # sorted when possible, so the key pickles the same in every process
+    try:
+        return tuple(sorted(items))
+    except TypeError:
+        return frozenset(items)
+
+
+def hashable(value):
+    """ Hashable form of nested lists, dicts and sets, equal for equal values """
+    if isinstance(value, dict):
+        return (dict, _ordered((k, hashable(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return (list, tuple(hashable(v) for v in value))
+    if isinstance(value, tuple):
+        return tuple(hashable(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return (frozenset, _ordered(hashable(v) for v in value))
+    return value
+
+
+_weakable: Dict[type, bool] = {}
+
+
+def _weak(value):
+    # weak reference to value if its type supports them, else value itself
+    cls = type(value)
+    ok = _weakable.get(cls)
+    if ok is None:
+        try:
+            weakref.ref(value)
+            ok = True
+        except TypeError:
+            ok = False
+        _weakable[cls] = ok
+    return weakref.ref(value) if ok else value
+
+
+def canonical_key(*args, **kwargs):
+    """ Key function for memoize(key=...) that accepts lists and dicts, like parsed json """
+    return make_key(hashable(args), {k: hashable(v) for k, v in kwargs.items()})
+
+
+class LRUCache(OrderedDict):
+    """ Dict that evicts least recently used entries
+
+    maxsize: max number of entries, 0 for no limit
+    maxbytes: max total of sizeof(value) over all entries, 0 for no limit
+    sizeof: size function, defaults to sys.getsizeof
+    ttl: entries are removed by sweep() this many seconds after they were set
+
+    Entries are ordered oldest first, call move_to_end(key) to mark one as used.
+    Changes are made under a lock, so one cache can be shared by threads.
+    Hits don't take it: move_to_end() only reorders, and sweep() returns
+    without it when nothing has expired.
+    """
+
+    def __init__(self, maxsize: int = 0, maxbytes: int = 0, sizeof: Callable[[Any], int] = None, ttl: float = 0):
+        super().__init__()
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof or sys.getsizeof
+        self.ttl = ttl
+        self.nbytes = 0
+        self.evictions = 0
+        self.expired = 0
+        self.__lock = threading.RLock()
+        self.__sizes: Dict[Any, int] = {}
+        # ttl is fixed, so expiry times are appended in order
+        self.__expiry: Deque[Tuple[float, Any]] = deque()
+        self.__expires: Dict[Any, float] = {}
+
+    def __setitem__(self, key, value):
+        with self.__lock:
+            if key in self:
+                self.__forget(key)
+                super().__setitem__(key, value)
+                # setting a key again counts as using it
+                super().move_to_end(key)
+            else:
+                super().__setitem__(key, value)
+            if self.maxbytes:
+                size = self.sizeof(value)
+                self.__sizes[key] = size
+                self.nbytes += size
+            if self.ttl:
+                expires = time.monotonic() + self.ttl
+                self.__expires[key] = expires
+                self.__expiry.append((expires, key))
+            self.__evict()
+            if len(self.__expiry) > 2 * len(self) + SWEEP_LIMIT:
+                self.__compact()
+
+    def sweep(self, limit: int = None, now: float = None) -> int:
+        """ Remove up to `limit` expired entries (all if None), returns the number removed """
+        if now is None:
+            now = time.monotonic()
+        # checked without the lock, so hits don't take it when nothing is due
+        try:
+            if self.__expiry[0][0] > now:
+                return 0
+        except IndexError:
+            return 0
+        removed = 0
+        with self.__lock:
+            expiry = self.__expiry
+            while expiry and expiry[0][0] <= now and (limit is None or removed < limit):
+                expires, key = expiry.popleft()
+                # skip records for keys that were set again, or are already gone
+                if self.__expires.get(key) == expires:
+                    self.pop(key, None)
+                    self.expired += 1
+                    removed += 1
+        return removed
+
+    def __delitem__(self, key):
+        with self.__lock:
+            super().__delitem__(key)
+            self.__forget(key)
+
+    def pop(self, key, *default):
+        with self.__lock:
+            if key in self:
+                self.__forget(key)
+            return super().pop(key, *default)
+
+    def popitem(self, last=True):
+        with self.__lock:
+            key, value = super().popitem(last)
+            self.__forget(key)
+            return key, value
+
+    def move_to_end(self, key, last=True):
+        # no lock: a single call that only changes the order, which sizes
+        # and expiry times don't depend on
+        super().move_to_end(key, last)
+
+    def clear(self):
+        with self.__lock:
+            super().clear()
+            self.__sizes.clear()
+            self.__expires.clear()
+            self.__expiry.clear()
+            self.nbytes = 0
+
+    def __compact(self):
+        # drop records of keys that were evicted, popped or set again, so they aren't kept alive
+        # __expires is in the order keys were last set, which is expiry order
+        self.__expiry = deque((expires, key) for key, expires in self.__expires.items())
+
+    def __forget(self, key):
+        self.nbytes -= self.__sizes.pop(key, 0)
+        self.__expires.pop(key, None)
+
+    def __evict(self):
+        while self and ((self.maxsize and len(self) > self.maxsize) or
+                        (self.maxbytes and self.nbytes > self.maxbytes)):
+            try:
+                self.popitem(last=False)
+            except KeyError:
+                break
+            self.evictions += 1
+
+
+class SqliteCache(MutableMapping):
+    """ Cache shared by processes on one host, stored in a sqlite database
+
+    Use as memoize(cache=SqliteCache(path, ttl=...)), so all workers of a
+    server share results instead of computing them once each.
+
+    path: database file, created if missing, one table per cache name
+    ttl: entries expire this many seconds after they were set, 0 for never
+    maxsize: max number of entries, oldest are removed first, 0 for no limit
+    scope: keys are stored with it, so caches with different scopes can share
+    a table without seeing each other's entries.  memoize scopes its cache to
+    the function's qualified name, see `scoped`.  maxsize counts all scopes.
+
+    Keys and values are pickled.  Expired entries are never returned, and are
+    deleted by sweep() and, a few at a time, by each write.  Times are wall
+    clock, see `clock`, since monotonic time isn't shared between processes.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, path: str, name: str = "memoize", ttl: float = 0, maxsize: int = 0, timeout: float = 10,
+                 scope: str = None):
+        self.path = path
+        self.name = name
+        self.scope = scope
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.evictions = 0
+        self.expired = 0
+        self.__local = threading.local()
+        self.__table = self._quote(name)
+        self.__count = self._quote(name + "_count")
+        with self._write() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS %s (key BLOB PRIMARY KEY, value BLOB, stored REAL, expires REAL)"
+                       % self.__table)
+            db.execute("CREATE INDEX IF NOT EXISTS %s ON %s (stored)" % (self._quote(name + "_stored"), self.__table))
+            db.execute("CREATE INDEX IF NOT EXISTS %s ON %s (expires)" % (self._quote(name + "_expires"), self.__table))
+            # row count kept by triggers, so writes don't count the table
+            db.execute("CREATE TABLE IF NOT EXISTS %s (n INTEGER)" % self.__count)
+            db.execute("INSERT INTO %s SELECT COUNT(*) FROM %s WHERE NOT EXISTS (SELECT 1 FROM %s)"
+                       % (self.__count, self.__table, self.__count))
+            db.execute("CREATE TRIGGER IF NOT EXISTS %s AFTER INSERT ON %s BEGIN UPDATE %s SET n = n + 1; END"
+                       % (self._quote(name + "_inserted"), self.__table, self.__count))
+            db.execute("CREATE TRIGGER IF NOT EXISTS %s AFTER DELETE ON %s BEGIN UPDATE %s SET n = n - 1; END"
+                       % (self._quote(name + "_deleted"), self.__table, self.__count))
+
+    def scoped(self, scope: str) -> "SqliteCache":
+        """ The same table and connections, with keys stored under `scope` """
+        new = object.__new__(SqliteCache)
+        new.__dict__.update(self.__dict__)
+        new.scope = scope
+        return new
+
+    @staticmethod
+    def _quote(name):
+        return '"%s"' % name.replace('"', '""')
+
+    @contextlib.contextmanager
+    def _write(self):
+        # one transaction, taking the write lock up front
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _db(self) -> sqlite3.Connection:
+        # one connection per thread, and never one inherited from a parent process
+        local = self.__local
+        if getattr(local, "pid", None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+
+    def _dump_key(self, key) -> bytes:
+        # without the memo, equal keys always pickle to equal bytes
+        if self.scope is not None:
+            key = (_SCOPE_MARK, self.scope, key)
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        pickler.fast = True
+        pickler.dump(key)
+        return f.getvalue()
+
+    def __getitem__(self, key):
+        row = self._db().execute(
+            "SELECT value FROM %s WHERE key = ? AND (expires IS NULL OR expires > ?)" % self.__table,
+            (self._dump_key(key), self.clock())).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        now = self.clock()
+        expires = now + self.ttl if self.ttl else None
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        key = self._dump_key(key)
+        with self._write() as db:
+            # an upsert, not INSERT OR REPLACE, whose implicit delete wouldn't fire the count trigger
+            if _UPSERT:
+                db.execute("INSERT INTO %s (key, value, stored, expires) VALUES (?, ?, ?, ?) ON CONFLICT (key) "
+                           "DO UPDATE SET value = excluded.value, stored = excluded.stored, expires = excluded.expires"
+                           % self.__table, (key, value, now, expires))
+            elif not db.execute("UPDATE %s SET value = ?, stored = ?, expires = ? WHERE key = ?"
+                                % self.__table, (value, now, expires, key)).rowcount:
+                db.execute("INSERT INTO %s (key, value, stored, expires) VALUES (?, ?, ?, ?)"
+                           % self.__table, (key, value, now, expires))
+            if self.ttl:
+                self.sweep(SWEEP_LIMIT, now)
+            if self.maxsize:
+                excess = db.execute("SELECT n FROM %s" % self.__count).fetchone()[0] - self.maxsize
+                if excess > 0:
+                    evicted = db.execute("DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY stored LIMIT ?)"
+                                         % (self.__table, self.__table), (excess,)).rowcount
+                    self.evictions += max(evicted, 0)
+
+    def __delitem__(self, key):
+        if not self._db().execute("DELETE FROM %s WHERE key = ?" % self.__table, (self._dump_key(key),)).rowcount:
+            raise KeyError(key)
+
+    def _keys(self):
+        # (stored key, key) of live entries in this scope
+        rows = self._db().execute(
+            "SELECT key FROM %s WHERE expires IS NULL OR expires > ?" % self.__table, (self.clock(),)).fetchall()
+        for row in rows:
+            key = pickle.loads(row[0])
+            if self.scope is not None:
+                if not (type(key) is tuple and len(key) == 3 and key[0] is _SCOPE_MARK and key[1] == self.scope):
+                    continue
+                key = key[2]
+            yield row[0], key
+
+    def __iter__(self):
+        for _, key in self._keys():
+            yield key
+
+    def __len__(self):
+        if self.scope is not None:
+            return sum(1 for _ in self._keys())
+        return self._db().execute(
+            "SELECT COUNT(*) FROM %s WHERE expires IS NULL OR expires > ?" % self.__table, (self.clock(),)).fetchone()[0]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self._db().execute("DELETE FROM %s WHERE key = ?" % self.__table, (self._dump_key(key),))
+        return value
+
+    def clear(self):
+        if self.scope is None:
+            self._db().execute("DELETE FROM %s" % self.__table)
+            return
+        with self._write() as db:
+            db.executemany("DELETE FROM %s WHERE key = ?" % self.__table, [(k,) for k, _ in self._keys()])
+
+    def count(self) -> int:
+        """ Number of rows, expired ones included, without scanning the table """
+        return self._db().execute("SELECT n FROM %s" % self.__count).fetchone()[0]
+
+    def sweep(self, limit: int = None, now: float = None) -> int:
+        """ Remove up to `limit` expired entries (all if None), returns the number removed """
+        if now is None:
+            now = self.clock()
+        removed = self._db().execute(
+            "DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s WHERE expires <= ? LIMIT ?)"
+            % (self.__table, self.__table), (now, -1 if limit is None else limit)).rowcount
+        removed = max(removed, 0)
+        self.expired += removed
+        return removed
+
+
+class CacheInfo(NamedTuple):
+    """ Statistics of a memoized function, see memoize.cache_info() """
+    hits: int
+    misses: int
+    evictions: int
+    expired: int
+    currsize: int
+    avg_compute_secs: float
+
+
+class _Stats:
+    # counters shared by a memoize and its bound copies, updated without a lock,
+    # so they can be slightly off under heavy concurrency
+    __slots__ = ("hits", "misses", "computes", "compute_secs")
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.computes = 0
+        self.compute_secs = 0.0
+
+    def computed(self, start):
+        self.computes += 1
+        self.compute_secs += time.perf_counter() - start
+
+
+# caches of instances that memoize can't store them in, see memoize.__get__
+_instance_caches: "weakref.WeakKeyDictionary[Any, Dict[Any, Any]]" = weakref.WeakKeyDictionary()
+
+# every memoized function in the process, see cache_infos()
+_registry: "weakref.WeakSet[memoize]" = weakref.WeakSet()
+
+
+def cache_infos() -> Dict[str, CacheInfo]:
+    """ cache_info() of every memoized function in the process, by qualified name """
+    infos: Dict[str, CacheInfo] = {}
+    for m in sorted(list(_registry), key=lambda m: m._name()):
+        name = m._name()
+        n = 1
+        while name in infos:
+            n += 1
+            name = "%s#%d" % (m._name(), n)
+        infos[name] = m.cache_info()
+    return infos
+
+
 class memoize():
     """ Very simple memoize wrapper
 
     function decorator: cache lives globally
-    method decorator: cache lives inside `obj_instance.__memoize_cache`
+    method decorator: cache lives inside `obj_instance.__memoize_cache`, one per method
+
+    maxsize/maxbytes: bound the cache, evicting least recently used entries (see LRUCache)
+    sizeof: weighs results for maxbytes, defaults to sys.getsizeof
+
+    With expire_secs, each call also removes up to SWEEP_LIMIT expired entries, so
+    memory follows the live working set.  sweep() removes all of them.
+
+    single_flight: concurrent misses on the same key wait for one call to func,
+    instead of all calling it
+
+    stale_secs: for up to this long after expire_secs, the expired result is still
+    returned while one refresh runs in a background thread.  Past that, callers
+    block on a fresh call as usual.
+
+    Coroutine functions are supported: calls return an awaitable, awaited results
+    are cached, and concurrent awaiters of the same key share one task.
+
+    cache_info() returns hit, miss and timing counters, cache_infos() has them for
+    every memoized function in the process.
+
+    cache: a dict like object, like SqliteCache to share results between processes.
+    A SqliteCache is scoped to the function's qualified name, so functions can share one.
+    Entry times come from the cache's `clock` attribute if it has one, else time.monotonic.
+
+    typed: arguments of different types are cached separately, so f(1) and f(1.0) differ
+    key: function of the call's arguments returning the cache key, for example
+    canonical_key to cache calls with list or dict arguments
+
+    weak: arguments that support weak references are held weakly, and entries are
+    dropped when they are collected.  Results that refer to their arguments still
+    keep them alive.
     """
 
-    def __init__(self, func: Callable[..., Any] = None, expire_secs: float = 0, obj=None, cache: Dict[Any, Any] = None):
+    def __init__(self, func: Callable[..., Any] = None, expire_secs: float = 0, obj=None, cache: Dict[Any, Any] = None,
+                 maxsize: int = 0, maxbytes: int = 0, sizeof: Callable[[Any], int] = None,
+                 single_flight: bool = False, stale_secs: float = 0,
+                 typed: bool = False, key: Callable[..., Any] = None, weak: bool = False):
         self.func = func
+        self.typed = typed
+        self.key = key
+        self.weak = weak
         self.expire_secs = expire_secs
+        self.stale_secs = stale_secs
+        self.single_flight = single_flight
+        # calls in progress, shared by all bound copies
+        self._flights: Dict[Any, Future] = {}
+        self._flights_lock = threading.Lock()
+        self._tasks: Dict[Any, Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        self._is_async = inspect.iscoroutinefunction(func)
+        self._stats = _Stats()
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
         self.cache = cache
         if cache is None:
-            self.cache = {}
+            self.cache = self._new_cache()
+        self._clock = getattr(self.cache, "clock", time.monotonic)
         if self.func is not None:
             functools.update_wrapper(self, func)
+            _registry.add(self)
+            self._scope_cache()
         self.obj = obj
 
+    def _new_cache(self):
+        if not (self.maxsize or self.maxbytes or self.expire_secs):
+            return {}
+        sizeof = self.sizeof or sys.getsizeof
+        # cache values are (result, time) tuples, only the result is weighed
+        # stale entries are kept around until they can't be served at all
+        ttl = self.expire_secs and self.expire_secs + self.stale_secs
+        return LRUCache(self.maxsize, self.maxbytes, lambda entry: sizeof(entry[0]), ttl=ttl)
+
+    def _copy(self, **attrs):
+        new = object.__new__(memoize)
+        new.__dict__.update(self.__dict__)
+        new.__dict__.update(attrs)
+        if "cache" in attrs:
+            new._clock = getattr(new.cache, "clock", time.monotonic)
+        return new
+
     def __get__(self, obj, objtype=None):
         if obj is None:
             # does this ever happen?
@@ -35,17 +568,33 @@ class memoize():
         else:
             # inject cache into the instance, so it doesn't live beyond the scope of the instance
             # without this, memoizing can cause serious unexpected memory leaks
+            # the bound copy is kept there too, so later lookups are a dict get
             try:
-                cache = obj.__memoize_cache          # pylint: disable=protected-access
+                bound = obj.__memoize_cache          # pylint: disable=protected-access
             except AttributeError:
                 try:
-                    cache = obj.__memoize_cache = {}
+                    bound = obj.__memoize_cache = {}
                 except Exception as e:
-                    # some objects don't work with injection
-                    log.warning("cannot inject cache: '%s', ensure object is a singleton, or pass a cache in!", e)
-                    cache = self.cache
+                    # some objects don't work with injection, like frozen dataclasses
+                    return self._fallback_copy(obj, e)
+            method = bound.get(self.func)
+            if method is None:
+                method = bound[self.func] = self._copy(cache=self._new_cache(), obj=obj)
+            return method
 
-        return memoize(self.func, expire_secs=self.expire_secs, cache=cache, obj=obj)
+        return self._copy(cache=cache, obj=obj)
+
+    def _fallback_copy(self, obj, error):
+        # keep the cache beside the instance, keyed weakly, holding the instance weakly too
+        try:
+            caches = _instance_caches.setdefault(obj, {})
+        except TypeError:
+            raise TypeError("memoize can't store a cache on %r (%s), pass cache= the name of an attribute "
+                            "holding one" % (type(obj).__name__, error)) from None
+        cache = caches.get(self.func)
+        if cache is None:
+            cache = caches[self.func] = self._new_cache()
+        return self._copy(cache=cache, obj=obj, weak=True)
 
     def __call__(self, *args, **kwargs):
         if self.func is None:
@@ -53,42 +602,248 @@ class memoize():
             # there should be no kwargs
             assert not kwargs
             func = args[0]
-            return memoize(func, expire_secs=self.expire_secs, cache=self.cache)
+            new = self._copy(func=func, _is_async=inspect.iscoroutinefunction(func), _stats=_Stats())
+            _registry.add(new)
+            functools.update_wrapper(new, func)
+            new._scope_cache()
+            return new
 
         if self.obj is not None:
             args = (self.obj, *args)
 
-        key = (args, tuple(sorted(kwargs.items())))
-        cur_time = time.monotonic()
+        if self.key is not None or self.typed or self.weak:
+            key = self._make_key(args, kwargs)
+        elif kwargs:
+            key = args + (_KWD_MARK,) + tuple(sorted(kwargs.items()))
+        else:
+            key = args
+
+        if not self.expire_secs and type(self.cache) is dict and not self._is_async:
+            # fast path for plain unbounded caches, nothing can be stale
+            entry = self.cache.get(key)
+            if entry is not None:
+                self._stats.hits += 1
+                return entry[0]
 
-        if key in self.cache:
-            (cresult, ctime) = self.cache[key]
-            if not self.expire_secs or cur_time < (ctime + self.expire_secs):
-                return cresult
+        cur_time = self._clock()
 
+        if self._is_async:
+            return self._acall(key, args, kwargs, cur_time)
+
+        entry = self._lookup(key, cur_time)
+        if entry is not None:
+            self._stats.hits += 1
+            if self.expire_secs and cur_time >= entry[1] + self.expire_secs:
+                self._refresh(key, args, kwargs)
+            return entry[0]
+
+        self._stats.misses += 1
+        if self.single_flight:
+            return self._call_once(key, args, kwargs)
+
+        start = time.perf_counter()
         result = self.func(*args, **kwargs)
-        self.cache[key] = (result, cur_time)
+        self._stats.computed(start)
+        self._store(key, (result, cur_time))
+        return result
+
+    def _lookup(self, key, cur_time):
+        # cached entry if it's fresh, or stale but within stale_secs
+        cache = self.cache
+        if type(cache) is LRUCache:
+            cache.sweep(SWEEP_LIMIT, cur_time)
+
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if self.expire_secs and cur_time >= (entry[1] + self.expire_secs + self.stale_secs):
+            return None
+        if type(cache) is LRUCache:
+            try:
+                cache.move_to_end(key)
+            except KeyError:
+                pass
+        return entry
+
+    async def _acall(self, key, args, kwargs, cur_time):
+        entry = self._lookup(key, cur_time)
+        if entry is not None:
+            self._stats.hits += 1
+            if self.expire_secs and cur_time >= entry[1] + self.expire_secs:
+                self._atask(key, args, kwargs).add_done_callback(self._log_refresh)
+            return entry[0]
+
+        self._stats.misses += 1
+
+        # shield, so one cancelled caller doesn't cancel the call for the others
+        return await asyncio.shield(self._atask(key, args, kwargs))
+
+    def _atask(self, key, args, kwargs):
+        # one task per key computes the result for all concurrent awaiters
+        loop = asyncio.get_event_loop()
+        flight = self._tasks.get(key)
+        if flight is not None and flight[0] is loop:
+            return flight[1]
+
+        task = loop.create_task(self._afly(args, kwargs, key))
+        self._tasks[key] = (loop, task)
+
+        def done(t):
+            if self._tasks.get(key, (None, None))[1] is t:
+                del self._tasks[key]
+
+        task.add_done_callback(done)
+        return task
+
+    async def _afly(self, args, kwargs, key):
+        cur_time = self._clock()
+        start = time.perf_counter()
+        result = await self.func(*args, **kwargs)
+        self._stats.computed(start)
+        self._store(key, (result, cur_time))
         return result
 
+    def _log_refresh(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error("refreshing %s: %r", getattr(self.func, "__name__", self.func), task.exception())
+
+    def _call_once(self, key, args, kwargs):
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+
+        if not leader:
+            return flight.result()
+
+        return self._fly(key, flight, args, kwargs)
+
+    def _fly(self, key, flight, args, kwargs):
+        try:
+            cur_time = self._clock()
+            # a previous flight may have finished since our miss
+            entry = self.cache.get(key)
+            if entry is not None and (not self.expire_secs or cur_time < (entry[1] + self.expire_secs)):
+                result = entry[0]
+            else:
+                start = time.perf_counter()
+                result = self.func(*args, **kwargs)
+                self._stats.computed(start)
+                self._store(key, (result, cur_time))
+            flight.set_result(result)
+            return result
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+
+    def _refresh(self, key, args, kwargs):
+        with self._flights_lock:
+            if key in self._flights:
+                return
+            flight = self._flights[key] = Future()
+        _refresh_pool().submit(self._background_fly, key, flight, args, kwargs)
+
+    def _background_fly(self, key, flight, args, kwargs):
+        try:
+            self._fly(key, flight, args, kwargs)
+        except Exception:
+            log.exception("refreshing %s%s", getattr(self.func, "__name__", self.func), args)
+
+    def sweep(self) -> int:
+        """ Remove all expired entries from the cache, returns the number removed """
+        cache = self.cache
+        if isinstance(cache, (LRUCache, SqliteCache)):
+            return cache.sweep()
+        if not self.expire_secs:
+            return 0
+        cutoff = self._clock() - self.expire_secs
+        expired = [key for key, (_, ctime) in list(cache.items()) if ctime <= cutoff]
+        for key in expired:
+            cache.pop(key, None)
+        return len(expired)
+
+    def cache_info(self) -> CacheInfo:
+        """ Hits, misses and compute time of this function, with the size of this cache
+
+        Counters are shared by all instances of a memoized method, while the
+        size, evictions and expired counts are those of the instance's cache.
+        """
+        stats = self._stats
+        cache = self.cache
+        return CacheInfo(hits=stats.hits, misses=stats.misses,
+                         evictions=getattr(cache, "evictions", 0), expired=getattr(cache, "expired", 0),
+                         currsize=len(cache),
+                         avg_compute_secs=stats.compute_secs / stats.computes if stats.computes else 0.0)
+
+    def _scope_cache(self):
+        # caches that can be shared by functions, like SqliteCache, keep this one's keys apart
+        scoped = getattr(self.cache, "scoped", None)
+        if scoped is not None and getattr(self.cache, "scope", None) is None:
+            self.cache = scoped(self._name())
+
+    def _name(self):
+        func = self.func
+        return "%s.%s" % (getattr(func, "__module__", None), getattr(func, "__qualname__", func))
+
+    def _make_key(self, args, kwargs):
+        if self.key is not None:
+            return self.key(*args, **kwargs)
+        if self.weak:
+            args = tuple(_weak(v) for v in args)
+            kwargs = {k: _weak(v) for k, v in kwargs.items()}
+        return make_key(args, kwargs, self.typed)
+
+    def _store(self, key, entry):
+        cache = self.cache
+        if self.weak:
+            # the stored key's references drop the entry, they go away with it when it's evicted
+            stored = []
+
+            def drop(_ref):
+                if stored:
+                    cache.pop(stored[0], None)
+
+            def rebind(part):
+                if type(part) is tuple:
+                    return tuple(rebind(p) for p in part)
+                if type(part) is weakref.ref:
+                    value = part()
+                    if value is None:
+                        raise ReferenceError
+                    return weakref.ref(value, drop)
+                return part
+
+            try:
+                key = rebind(key)
+            except ReferenceError:
+                return
+            stored.append(key)
+        cache[key] = entry
+
     def clear(self, *args, **kwargs):
         if self.obj is not None:
             args = (self.obj, *args)
-        key = (args, tuple(sorted(kwargs.items())))
+        key = self._make_key(args, kwargs)
         self.cache.pop(key, None)
 
     def get(self, *args, **kwargs):
         if self.obj is not None:
             args = (self.obj, *args)
-        key = (args, tuple(sorted(kwargs.items())))
-        if key in self.cache:
-            return self.cache[key][0]
+        key = self._make_key(args, kwargs)
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry[0]
         return None
 
     def set(self, *args, _value, **kwargs):
         if self.obj is not None:
             args = (self.obj, *args)
-        key = (args, tuple(sorted(kwargs.items())))
-        self.cache[key] = (_value, time.monotonic())
+        key = self._make_key(args, kwargs)
+        self._store(key, (_value, self._clock()))
 
 def test_memoize1():
     func = lambda *a: (a, os.urandom(32))
@@ -202,3 +957,465 @@ def test_memoize4():
     x = Cls()
     y = x.fun(1)
     assert list(x.foo.values())[0][0] == y
+
+
+def test_memoize_maxsize():
+    calls = []
+
+    @memoize(maxsize=2)
+    def fun(a):
+        calls.append(a)
+        return a
+
+    fun(1)
+    fun(2)
+    fun(1)
+    # 2 is least recently used
+    fun(3)
+    assert len(fun.cache) == 2
+    assert fun.cache.evictions == 1
+    fun(1)
+    assert calls == [1, 2, 3]
+    fun(2)
+    assert calls == [1, 2, 3, 2]
+
+
+def test_lru_set_again():
+    cache = LRUCache(maxsize=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    cache["a"] = 3
+    cache["c"] = 4
+    assert list(cache) == ["a", "c"]
+    assert cache["a"] == 3
+
+
+def test_lru_expiry_compacted():
+    import gc
+
+    cache = LRUCache(maxsize=10, ttl=3600)
+    for i in range(100000):
+        cache[i] = i
+    assert len(cache) == 10
+    assert len(cache._LRUCache__expiry) <= 2 * 10 + SWEEP_LIMIT + 1
+
+    class Arg:
+        pass
+
+    @memoize(maxsize=10, expire_secs=3600)
+    def fun(arg):
+        return 1
+
+    refs = []
+    for _ in range(1000):
+        arg = Arg()
+        refs.append(weakref.ref(arg))
+        fun(arg)
+    del arg
+    gc.collect()
+    assert sum(ref() is not None for ref in refs) <= 2 * 10 + SWEEP_LIMIT + 1
+
+
+def test_lru_threads():
+    cache = LRUCache(maxbytes=10 ** 6, sizeof=len)
+
+    def work(n):
+        for i in range(2000):
+            cache[(i + n) % 50] = "x" * (i % 7 + 1)
+            cache.pop((i * n) % 50, None)
+
+    # switch threads often, so races show up
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert cache.nbytes == sum(len(v) for v in cache.values())
+
+
+def test_memoize_maxbytes():
+    @memoize(maxbytes=100, sizeof=len)
+    def fun(n):
+        return "x" * n
+
+    fun(40)
+    fun(50)
+    assert fun.cache.nbytes == 90
+    fun(30)
+    assert fun.cache.nbytes == 80
+    assert fun.get(40) is None
+    fun.clear(50)
+    assert fun.cache.nbytes == 30
+
+
+def test_memoize_method_caches():
+    class Cls:
+        @memoize(maxsize=1)
+        def fun(self, a):
+            return ("fun", a)
+
+        @memoize
+        def fun2(self, a):
+            return ("fun2", a)
+
+    c = Cls()
+    assert c.fun(1) == ("fun", 1)
+    # same args, different method
+    assert c.fun2(1) == ("fun2", 1)
+    c.fun(2)
+    assert c.fun.get(1) is None
+    assert len(c.fun.cache) == 1
+
+
+def test_memoize_sweep():
+    @memoize(expire_secs=0.05)
+    def fun(a):
+        return a
+
+    for i in range(20):
+        fun(i)
+    assert len(fun.cache) == 20
+    time.sleep(0.06)
+
+    # each call purges a few expired entries
+    fun(100)
+    assert len(fun.cache) == 20 - SWEEP_LIMIT + 1
+    assert fun.sweep() == 20 - SWEEP_LIMIT
+    assert list(fun.cache) == [(100,)]
+    assert fun.cache.expired == 20
+
+    # re-set keys are not expired early
+    fun.set(100, _value=5)
+    assert fun.sweep() == 0
+    assert fun(100) == 5
+
+
+def test_memoize_sweep_dict():
+    cache = {}
+    fun = memoize(lambda a: a, expire_secs=0.05, cache=cache)
+    fun(1)
+    time.sleep(0.06)
+    fun(2)
+    assert fun.sweep() == 1
+    assert len(cache) == 1
+
+
+def test_memoize_single_flight():
+    from concurrent.futures import ThreadPoolExecutor
+    calls = []
+
+    @memoize(single_flight=True, expire_secs=60)
+    def slow(a):
+        calls.append(a)
+        time.sleep(0.1)
+        return a * 2
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(slow, [1] * 8 + [2] * 8))
+
+    assert results == [2] * 8 + [4] * 8
+    assert sorted(calls) == [1, 2]
+    assert not slow._flights
+
+
+def test_memoize_single_flight_error():
+    from concurrent.futures import ThreadPoolExecutor
+
+    @memoize(single_flight=True)
+    def fail(a):
+        time.sleep(0.05)
+        raise ValueError(a)
+
+    def call(a):
+        try:
+            fail(a)
+        except ValueError:
+            return "err"
+
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(call, [1] * 4)) == ["err"] * 4
+    assert not fail.cache
+
+
+def test_memoize_stale():
+    calls = []
+
+    @memoize(expire_secs=0.2, stale_secs=0.5)
+    def slow(a):
+        calls.append(a)
+        time.sleep(0.05)
+        return len(calls)
+
+    assert slow(1) == 1
+    time.sleep(0.25)
+
+    # expired: served stale without waiting, refreshed in the background
+    t = time.monotonic()
+    assert slow(1) == 1
+    assert slow(1) == 1
+    assert time.monotonic() - t < 0.04
+    time.sleep(0.1)
+    assert slow(1) == 2
+    assert len(calls) == 2
+
+    # past the staleness bound callers block
+    time.sleep(0.8)
+    assert slow(1) == 3
+
+
+def test_memoize_async():
+    calls = []
+
+    @memoize(expire_secs=60)
+    async def fetch(a):
+        calls.append(a)
+        await asyncio.sleep(0.05)
+        return a * 2
+
+    async def main():
+        first = await asyncio.gather(*[fetch(1) for _ in range(5)], fetch(2))
+        again = await fetch(1)
+        return first, again
+
+    loop = asyncio.new_event_loop()
+    try:
+        first, again = loop.run_until_complete(main())
+    finally:
+        loop.close()
+
+    assert first == [2, 2, 2, 2, 2, 4]
+    assert again == 2
+    assert sorted(calls) == [1, 2]
+    assert fetch.get(1) == 2
+    assert not fetch._tasks
+
+
+def test_memoize_async_method():
+    class Cls:
+        @memoize
+        async def fun(self, a):
+            return (a, os.urandom(8))
+
+    c = Cls()
+    loop = asyncio.new_event_loop()
+    try:
+        x = loop.run_until_complete(c.fun(1))
+        assert loop.run_until_complete(c.fun(1)) == x
+        assert loop.run_until_complete(Cls().fun(1)) != x
+    finally:
+        loop.close()
+    assert c.fun.get(1) == x
+
+
+def test_memoize_keys():
+    calls = []
+
+    @memoize
+    def fun(*a, **k):
+        calls.append(1)
+        return a, k
+
+    fun(1, 2)
+    fun(1, b=2)
+    fun(1, 2)
+    fun(1, b=2)
+    # kwargs are marked, so they can't collide with positional tuples
+    fun(1, ('b', 2))
+    assert len(calls) == 3
+
+    @memoize(typed=True)
+    def typed(a):
+        return type(a)
+
+    assert typed(1) is int
+    assert typed(1.0) is float
+
+
+def test_memoize_canonical_key():
+    calls = []
+
+    @memoize(key=canonical_key)
+    def fun(q, opts=None):
+        calls.append(q)
+        return len(q)
+
+    assert fun({"x": [1, 2], "y": {"z": 1}}) == 2
+    assert fun({"y": {"z": 1}, "x": [1, 2]}) == 2
+    assert fun({"x": [1, 2]}, opts=[3]) == 1
+    assert fun({"x": [1, 2]}, opts=[3]) == 1
+    assert len(calls) == 2
+    assert hashable([1]) != hashable((1,))
+    assert fun.get({"x": [1, 2]}, opts=[3]) == 1
+
+
+def test_sqlite_cache():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.db")
+        cache = SqliteCache(path, maxsize=3)
+        cache[(1, _KWD_MARK, ("b", [2]))] = "x"
+        assert cache[(1, _KWD_MARK, ("b", [2]))] == "x"
+        assert pickle.loads(pickle.dumps(_KWD_MARK)) is _KWD_MARK
+        for i in range(5):
+            cache[i] = i
+        assert sorted(cache) == [2, 3, 4]
+        assert cache.evictions == 3
+        cache[4] = "again"
+        assert cache.count() == 3 and sorted(cache) == [2, 3, 4]
+        assert cache.pop(3) == 3 and cache.pop(3, None) is None
+        del cache[2]
+        assert len(cache) == 1
+
+        global _UPSERT
+        upsert, _UPSERT = _UPSERT, False
+        try:
+            old = SqliteCache(path, name="old", maxsize=2)
+            for i in (1, 2, 1, 3, 3):
+                old[i] = str(i)
+            assert old.count() == 2 and sorted(old) == [1, 3]
+            assert old[3] == "3"
+        finally:
+            _UPSERT = upsert
+
+        short = SqliteCache(path, name="short", ttl=0.05)
+        short["a"] = 1
+        assert short["a"] == 1
+        time.sleep(0.1)
+        assert "a" not in short
+        assert short.sweep() == 1
+
+
+def test_memoize_shared():
+    import tempfile
+    calls = []
+
+    def fun(a, b=None):
+        calls.append(a)
+        return [a, b]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.db")
+        # separate caches on one file, as in separate worker processes
+        worker1 = memoize(fun, expire_secs=60, cache=SqliteCache(path, ttl=60))
+        worker2 = memoize(fun, expire_secs=60, cache=SqliteCache(path, ttl=60))
+        assert worker1(1, b={"x": 1}) == [1, {"x": 1}]
+        thread = threading.Thread(target=lambda: calls.append(worker2(1, b={"x": 1})))
+        thread.start()
+        thread.join()
+        assert calls == [1, [1, {"x": 1}]]
+
+        worker2.clear(1, b={"x": 1})
+        assert worker1.get(1, b={"x": 1}) is None
+
+
+def test_memoize_shared_file():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache.db")
+
+        @memoize(cache=SqliteCache(path))
+        def double(a):
+            return a * 2
+
+        @memoize(cache=SqliteCache(path))
+        def square(a):
+            return a * a
+
+        assert double(5) == 10
+        assert square(5) == 25
+        assert double(5) == 10
+        assert list(double.cache) == [(5,)] and len(square.cache) == 1
+        double.cache.clear()
+        assert square.get(5) == 25 and double.get(5) is None
+        assert SqliteCache(path).count() == 1
+
+
+def test_memoize_cache_info():
+    @memoize(maxsize=2)
+    def fun(a):
+        time.sleep(0.01)
+        return a
+
+    fun(1)
+    fun(1)
+    fun(2)
+    fun(3)
+    info = fun.cache_info()
+    assert (info.hits, info.misses, info.evictions, info.currsize) == (1, 3, 1, 2)
+    assert info.avg_compute_secs >= 0.01
+
+    class Cls:
+        @memoize
+        def meth(self, a):
+            return a
+
+    obj1, obj2 = Cls(), Cls()
+    obj1.meth(1)
+    obj2.meth(1)
+    obj2.meth(1)
+    assert obj2.meth.cache_info()[:2] == (1, 2)
+
+    infos = cache_infos()
+    assert infos[__name__ + ".test_memoize_cache_info.<locals>.fun"] == info
+    assert __name__ + ".test_memoize_cache_info.<locals>.Cls.meth" in infos
+
+
+def test_memoize_weak():
+    import gc
+
+    class Req:
+        pass
+
+    @memoize(weak=True)
+    def fun(req, n):
+        return n
+
+    req = Req()
+    assert fun(req, 1) == 1
+    assert fun(req, 1) == 1
+    assert fun.cache_info().hits == 1
+    assert len(fun.cache) == 1
+    del req
+    gc.collect()
+    assert len(fun.cache) == 0
+
+
+def test_memoize_fallback():
+    import gc
+
+    class Frozen:
+        # like a frozen dataclass, attributes can't be set after __init__
+        def __init__(self, a):
+            object.__setattr__(self, "a", a)
+
+        def __setattr__(self, name, value):
+            raise AttributeError("can't set %s" % name)
+
+        @memoize
+        def fun(self, b):
+            return (self.a, b, os.urandom(8))
+
+    obj = Frozen(1)
+    assert obj.fun(2) == obj.fun(2)
+    assert len(_instance_caches) == 1
+    del obj
+    gc.collect()
+    assert len(_instance_caches) == 0
+
+    class Slots:
+        __slots__ = ()
+
+        @memoize
+        def fun(self):
+            return 1
+
+    try:
+        Slots().fun()
+        assert False
+    except TypeError as e:
+        assert "pass cache=" in str(e)
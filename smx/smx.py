@@ -2,15 +2,55 @@
 
 import os, sys, io
 import six
+import builtins
+import time
 import logging
+import threading
+from collections import OrderedDict, ChainMap
+from collections.abc import Mapping
+from types import GeneratorType
 
 __version__ = "0.9.5"
 
 from tempfile import NamedTemporaryFile
 
+from .template import Parser, Source, FileCache, chunked
+from .memoize import memoize, make_key, LRUCache
+
 log = logging.getLogger(__name__)
 
+# size of the pieces streamed by macros that produce a lot of output
+STREAM_CHUNK = 64 * 1024
+
+# default number of results kept by each @macro(cache=True)
+MACRO_CACHE_SIZE = 1024
+
+# bounds of each store used by the cache macro: entries, and total characters
+FRAGMENT_CACHE_SIZE = 256
+FRAGMENT_CACHE_CHARS = 16 * 1024 * 1024
+
+# context passed to a cached macro's function when used outside a render
+_NO_CONTEXT = object()
+
+
+def _fragment_cache():
+    # values are (text, expiry time or None)
+    return LRUCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_CHARS, sizeof=lambda entry: len(entry[0]))
+
 def macro(*args, **kws):
+    """Mark a method of an Smx subclass as a macro
+
+    name: macro name, defaults to the function name
+    quote: argument numbers that are passed unexpanded
+    cache: cache results by argument, in every context, for macros that
+      return strings and only depend on their arguments
+    ttl: seconds a cached result is used, 0 for no limit
+    maxsize: max cached results, defaults to MACRO_CACHE_SIZE
+
+    A cached macro's `cache` attribute is its memoize, bound so that get,
+    set and clear take the macro's arguments without a context, as in
+    `MyCtx.lookup.cache.clear("name")`.
+    """
     if not kws:
         func = args[0]
         def wrap(*arg, **kw):
@@ -21,54 +61,254 @@ def macro(*args, **kws):
         return wrap
     else:
         def outer(func):
+            if kws.get("cache"):
+                # the context is left out of the key, so all contexts share results
+                func = memoize(func, expire_secs=kws.get("ttl", 0),
+                               maxsize=kws.get("maxsize") or MACRO_CACHE_SIZE,
+                               key=lambda ctx, *a, **kw: make_key(a, kw))
             def wrap(*arg, **kw):
                 return func(*arg, **kw)
+            if kws.get("cache"):
+                # shares the cache and counters, fills in the context for get, set and clear
+                wrap.cache = func._copy(obj=_NO_CONTEXT)
             wrap.is_macro = True
             wrap.quoted = kws.get("quote")
             wrap.__name__ = kws.get("name") or func.__name__
             return wrap
         return outer
 
+class CodeCache:
+    """Bounded LRU of compiled python code, keyed by source text and mode
+
+    Syntax errors are cached too, so `python` can try "eval" then "exec"
+    without recompiling either on every call.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__codes = OrderedDict()
+
+    def get(self, src, mode):
+        key = (src, mode)
+        try:
+            code = self.__codes[key]
+            self.__codes.move_to_end(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            try:
+                code = compile(src, "<string>", mode)
+            except SyntaxError as e:
+                code = e
+            self.__codes[key] = code
+            while len(self.__codes) > self.maxsize:
+                try:
+                    self.__codes.popitem(last=False)
+                except KeyError:
+                    break
+
+        if isinstance(code, SyntaxError):
+            raise SyntaxError(*code.args)
+        return code
+
+    def clear(self):
+        self.__codes.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__codes)
+
+
+def _chain_get(scope, name):
+    # ChainMap.get checks `in` then indexes every map, this is one pass of dict.get
+    # lookups are O(depth), one dict.get per scope, resolutions aren't cached per
+    # frame: %set and loop variables would have to invalidate them, and scope
+    # chains are a few maps deep (fork, init, loops), so a cache costs more than it saves
+    if type(scope) is ChainMap:
+        for m in scope.maps:
+            f = m.get(name)
+            if f is not None:
+                return f
+        return None
+    return scope.get(name)
+
+
+class _Macros(Mapping):
+    """A context's macros, bound to the context on first use"""
+
+    def __init__(self, ctx):
+        self.__ctx = ctx
+        self.__table = ctx._macro_table()
+        self.__bound = {}
+
+    def get(self, name, default=None):
+        f = self.__bound.get(name)
+        if f is None:
+            func = self.__table.get(name)
+            if func is None:
+                return default
+            f = (lambda func, self: lambda *args: func(self, *args))(func, self.__ctx)
+            f.quoted = func.quoted
+            self.__bound[name] = f
+        return f
+
+    def __getitem__(self, name):
+        f = self.get(name)
+        if f is None:
+            raise KeyError(name)
+        return f
+
+    def __iter__(self):
+        return iter(self.__table)
+
+    def __len__(self):
+        return len(self.__table)
+
+
+class _PyBuiltins(dict):
+    """Builtins for `eval` and `python` in a context: its macros, then python's
+
+    Names are looked up on first use, so running python in a fork binds only
+    the macros the code uses.
+    """
+
+    def __init__(self, macros):
+        # the interpreter reads these without falling back to __missing__
+        super().__init__(__import__=builtins.__import__, __build_class__=builtins.__build_class__)
+        self.__macros = macros
+
+    def __missing__(self, name):
+        f = self.__macros.get(name)
+        if f is None:
+            f = builtins.__dict__[name]
+        self[name] = f
+        return f
+
+
+class _Defined:
+    """A macro made by `define`, its body renders in the calling context"""
+
+    __slots__ = ("name", "tpl", "args")
+
+    def __init__(self, name, tpl, args):
+        self.name = name
+        self.tpl = tpl
+        self.args = args
+
+    def __call__(self, ctx, *vals):
+        if len(vals) != len(self.args):
+            raise TypeError("%s() takes %s positional arguments but %s were given" % (self.name, len(self.args), len(vals)))
+        ctx.push_local(dict(zip(self.args, vals)))
+        try:
+            return self.tpl.expand(ctx)
+        finally:
+            ctx.pop_local()
+
+    def bind(self, ctx):
+        return lambda *vals: self(ctx, *vals)
+
+
+class _Frame(threading.local):
+    """Per thread render state of a context
+
+    Lets many threads render through one shared context: each has its own
+    innermost scope, current macro position and `python` output.
+    """
+    scope = None
+    output = None
+    func_lno = 0
+    func_off = 0
+    fi_lno = 1
+    fi_name = "<inline>"
+
+
 class Smx:
     funcs = {}
+    codes = CodeCache()
+    files = FileCache()
+    # fragments shared by all contexts, see the cache macro
+    fragments = _fragment_cache()
 
     def __init__(self, init={}, environ={}):
 
         self.environ = environ
-        self.__fi_lno = 1
-        self.__fi_off = 0
-        self.__fi_name = "<inline>"
-        self.__locals = {}
-        self.__globals = {
+        self.__frame = _Frame()
+        self.__globals = ChainMap({
                 "os" : os,
                 "sys" : sys,
                 "version" : __version__,
-        }
-        self.__stack = []
+        }, _Macros(self))
+        self.__py_globals = None
         if isinstance(init, Smx):
             init = init.__locals
-        self.__locals.update(init)
-
-        for name, func in self.__class__.__dict__.items():
-            if hasattr(func, "is_macro"):
-                f = (lambda func, self: lambda *args: func(self, *args))(func, self)
-                f.quoted = func.quoted
-                self.__globals[func.__name__] = f
-                if func.__name__ in ["expand","module"]:
-                    globals()[func.__name__] = f
+        self.__locals = ChainMap(dict(init))
+        self.__fragments = _fragment_cache()
+
+    def fork(self, environ=None):
+        """New context layered over this one, created in O(1)
+
+        The child sees this context's globals and locals, but `set`,
+        `define` and `module` in the child only change the child.  Macros
+        are bound to the child lazily, on first use.
+        """
+        child = object.__new__(self.__class__)
+        # keep attributes set by subclasses, then layer the context state
+        child.__dict__.update(self.__dict__)
+        child.environ = self.environ if environ is None else environ
+        child.__frame = _Frame()
+        child.__locals = self._scope().new_child()
+        child.__globals = ChainMap({}, *self.__globals.maps[:-1], _Macros(child))
+        child.__py_globals = None
+        child.__fragments = self.__fragments
+        return child
+
+    @classmethod
+    def _macro_table(cls):
+        # name -> unbound macro function, for this class and its bases
+        table = cls.__dict__.get("_macro_cache")
+        if table is None:
+            table = {}
+            for klass in reversed(cls.__mro__):
+                for func in vars(klass).values():
+                    if hasattr(func, "is_macro"):
+                        table[func.__name__] = func
+            cls._macro_cache = table
+        return table
+
+    def _set_global(self, name, val):
+        self.__globals[name] = val
+        if self.__py_globals is not None:
+            self.__py_globals[name] = val.bind(self) if type(val) is _Defined else val
+
+    def _py_globals(self):
+        # eval and exec need a real dict for globals, built once per context
+        # macros come from __builtins__, bound lazily
+        if self.__py_globals is None:
+            py_globals = dict(ChainMap(*self.__globals.maps[:-1]))
+            for name, val in py_globals.items():
+                if type(val) is _Defined:
+                    py_globals[name] = val.bind(self)
+            py_globals["__builtins__"] = _PyBuiltins(self.__globals.maps[-1])
+            self.__py_globals = py_globals
+        return self.__py_globals
 
     @macro
     def python(self, data):
         try:
-            return str(eval(data, self.__globals, self.__locals))
+            code = self.codes.get(data, "eval")
         except SyntaxError:
-            self.__output = None
-            exec(data, self.__globals, self.__locals)
-            return self.__output
+            frame = self.__frame
+            frame.output = None
+            exec(self.codes.get(data, "exec"), self._py_globals(), self._scope())
+            return frame.output
+        return str(eval(code, self._py_globals(), self._scope()))
 
     @macro
     def output(self, data):
-        self.__output = str(data)
+        self.__frame.output = str(data)
 
     @macro
     def strip(self, data, chars=None):
@@ -76,12 +316,12 @@ class Smx:
 
     @macro
     def include(self, f):
-        return open(f).read()
+        return self.files.text(f)
 
     @macro
     def indent(self, data, n=None):
         if n is None:
-            n = self.__func_off
+            n = self.__frame.func_off
         else:
             n = int(n)
 
@@ -98,59 +338,96 @@ class Smx:
 
     @macro
     def eval(self, code):
-        return eval(code, self.__globals, self.__locals)
+        return eval(self.codes.get(code, "eval"), self._py_globals(), self._scope())
 
     @macro(name="if",quote=[2,3])
     def _if(self, cond, do1, do2):
-        ret = ""
-        if cond and eval(cond):
-            ret += self.expand(str(do1))
+        if cond and self.eval(cond):
+            return self.template(do1).expand(self)
         else:
-            ret += self.expand(str(do2))
-        return ret
+            return self.template(do2).expand(self)
 
     @macro(name="for",quote=[3])
     def _for(self, name, loop, do):
-        ret = ""
+        # yields output in chunks, so long loops can be streamed
+        tpl = self.template(do)
+        fo = io.StringIO()
         locs = {}
         self.push_local(locs)
-        for x in eval(loop):
-            locs[name]=x
-            ret += self.expand(str(do))
-        return ret
+        try:
+            for x in self.eval(loop):
+                locs[name]=x
+                tpl.render(self, fo)
+                if fo.tell() >= STREAM_CHUNK:
+                    # leave the loop scope while suspended, so other renders
+                    # on this context don't see the loop variable
+                    self.pop_local()
+                    try:
+                        yield fo.getvalue()
+                    finally:
+                        self.push_local(locs)
+                    fo = io.StringIO()
+        finally:
+            self.pop_local()
+        yield fo.getvalue()
+
+    @macro(quote=[3])
+    def cache(self, key, ttl, body, scope="context"):
+        # output of body is reused until ttl seconds pass, 0 for no limit
+        if scope == "context":
+            store = self.__fragments
+        elif scope == "process":
+            store = self.fragments
+        else:
+            raise ValueError("cache scope must be 'context' or 'process', not %r" % scope)
+
+        now = time.monotonic()
+        entry = store.get(key)
+        if entry is not None and (entry[1] is None or now < entry[1]):
+            try:
+                store.move_to_end(key)
+            except KeyError:
+                pass
+            return entry[0]
+
+        text = self.template(body).expand(self)
+        ttl = float(ttl or 0)
+        store[key] = (text, now + ttl if ttl else None)
+        return text
 
     @macro(quote=[2])
     def define(self, name, body, *args):
-        j_names = ','.join(args)
-        defs = ""
-        for arg in args:
-            defs += "    self._Smx__locals['" + arg + "']=" + arg + "\n"
-        code = """def _tmp(self, """ + j_names + """):
-    self.push_local({})
-""" + defs + """
-    self.__res = self.expand('''""" + body + """''')
-    self.pop_local()
-    return self.__res
-"""
-        locs = {}
-        exec(code, globals(), locs)
-        self.__globals[name] = lambda *args: locs["_tmp"](self, *args)
+        # bound to the context that calls it, so forks see their own locals
+        self._set_global(name, _Defined(name, self.template(body), args))
+
+    def _scope(self):
+        # innermost scope of the render running in this thread
+        scope = self.__frame.scope
+        return self.__locals if scope is None else scope
 
     def pop_local(self):
-        if self.__stack:
-            self.__locals = self.__stack.pop()
+        """Leave the innermost scope, the context's own scope is never popped"""
+        scope = self.__frame.scope
+        if scope is not None:
+            if len(scope.maps) > len(self.__locals.maps) + 1:
+                self.__frame.scope = scope.parents
+            else:
+                self.__frame.scope = None
 
     def push_local(self, x):
-        self.__stack.append(x)
-        self.__locals = x 
+        """Enter a new scope, the dict `x`, nested inside the current one
+
+        Names in outer scopes stay visible, new names go into `x`.
+        """
+        self.__frame.scope = self._scope().new_child(x)
 
     @macro
     def set(self, key, val):
-        self.__locals[key] = val
+        self._scope()[key] = val
 
     @macro
     def get(self, key):
-        return self.__locals.get(key,self.__globals.get(key,""))
+        return self._scope().get(key,self.__globals.get(key,""))
 
     @macro
     def add(self, a, b):
@@ -168,22 +445,39 @@ class Smx:
 
     @macro
     def module(self, name):
-        self.__globals[name] = new_module = __import__(name)
+        self._set_global(name, __import__(name))
 
     @macro
     def expand(self, dat):
-        fi = io.StringIO(six.u(dat))
-        fo = io.StringIO()
         log.debug("expand '%s", dat)
-        self.expand_io(fi, fo)
-        return str(fo.getvalue())
+        return self.compile(dat).expand(self)
+
+    def compile(self, src, name="<inline>"):
+        """Parse a string or file-like object into a reusable `Template`
+
+        Render the result with `template.render(ctx, out)`.  Which macro
+        arguments are quoted is decided when the template is compiled.
+        """
+        if not isinstance(src, str):
+            name = getattr(src, "name", name)
+            src = src.read()
+        return Parser(self, six.u(src), name).parse()
+
+    def template(self, src):
+        """Compiled template for a quoted macro argument, parsed only once"""
+        tpl = getattr(src, "template", None)
+        if tpl is None:
+            tpl = self.compile(src)
+            if isinstance(src, Source):
+                src.template = tpl
+        return tpl
 
     def expand_file(self, file_name, output_stream=None, in_place=False):
         log.debug("expand file %s" % file_name)
-        fi = io.open(file_name)
-
-        self.__fi_name = file_name
-        self.__fi_lno = 1
+        with io.open(file_name) as fi:
+            self.__frame.fi_name = file_name
+            self.__frame.fi_lno = 1
+            tpl = self.compile(fi)
 
         if in_place:
             fo = NamedTemporaryFile(prefix=file_name, dir=os.path.dirname(file_name) or ".", delete=False, mode="w")
@@ -193,96 +487,71 @@ class Smx:
             log.debug("using stdout")
             fo = sys.stdout
 
-        self.expand_io(fi, fo)
+        tpl.render(self, fo)
 
         if in_place:
             fo.close()
             os.rename(fo.name, file_name) 
 
-    def expand_io(self, fi, fo, term=[], in_c=None):
-        c = in_c or fi.read(1)
-        par = 0
-        tmp = u''
-        while c != '':
-            if c == '\n':
-                self.__fi_lno += 1
-                self.__fi_off = 0
-            elif c == ' ':
-                self.__fi_off += 1
-            elif c == '(':
-                par += 1
-
-            if c in term and not par:
-                return c
-
-            if c == ')':
-                par -= 1
-
-            if c == ' ':
-                tmp += c
-            else:
-                fo.write(tmp)
-                tmp = u''
-
-            if c != '%':
-                if c != ' ':
-                    fo.write(c)
-                c = fi.read(1)
-                continue
-
-            if (c=='%'):
-                c = fi.read(1)
-                if (c == '%'):
-                    fo.write(c)
-                    c = fi.read(1)
-                    continue
-
-                name = ""
-                while (c.isalnum() or c == "."):
-                    name += c
-                    c = fi.read(1)
-
-                args = []
-
-                f = self.__locals.get(name) or self.__globals.get(name)
-                quoted = f and getattr(f, "quoted", None)
-
-                lno = self.__fi_lno
-                off = self.__fi_off
-                if c == '%':
-                    self._exec(name, args, fi, fo, lno, off)
-                elif c == '(':
-                    anum = 1
-                    noexp = quoted and anum in quoted
-                    arg, tc = self._exparg(name, anum, fi, no_expand=noexp)
-                    while arg is not None:
-                        args.append(arg)
-                        if tc != ',':
-                            break
-                        anum += 1
-                        noexp = quoted and anum in quoted
-                        arg, tc = self._exparg(name, anum, fi, no_expand=noexp)
-
-                    self._exec(name, args, fi, fo, lno, off)
-                else:
-                    self._error(SyntaxError("unterminated macro"))
+    def iter_expand(self, dat, chunk_size=STREAM_CHUNK):
+        """Expand a string, yielding output in chunks of `chunk_size` chars
 
-            c = fi.read(1)
+        Output is produced as the template runs, so memory use does not grow
+        with the size of the output.
+        """
+        return chunked(self.compile(dat).iter_render(self), chunk_size)
+
+    def iter_expand_file(self, file_name, chunk_size=STREAM_CHUNK):
+        """Expand a file, yielding output in chunks, see `iter_expand`"""
+        log.debug("expand file %s" % file_name)
+        with io.open(file_name) as fi:
+            self.__frame.fi_name = file_name
+            self.__frame.fi_lno = 1
+            tpl = self.compile(fi)
+        return chunked(tpl.iter_render(self), chunk_size)
+
+    def expand_io(self, fi, fo):
+        self.compile(fi).render(self, fo)
+
+    def _lookup(self, name):
+        return _chain_get(self._scope(), name) or _chain_get(self.__globals, name)
+
+    def _exec(self, name, args, fo, lno, off):
+        res = self._call(name, args, lno, off)
+        if isinstance(res, GeneratorType):
+            for s in self._stream(res, lno):
+                fo.write(s)
+        elif res is not None:
+            fo.write(six.u(str(res)))
+
+    def _iter_exec(self, name, args, lno, off):
+        res = self._call(name, args, lno, off)
+        if isinstance(res, GeneratorType):
+            return self._stream(res, lno)
+        elif res is not None:
+            return (six.u(str(res)),)
+        return ()
+
+    def _stream(self, gen, lno):
+        # macros can return a generator to stream large results, like `for`
+        try:
+            for s in gen:
+                yield six.u(str(s))
+        except Exception as e:
+            self._error(e, lno=lno)
 
-    def _exec(self, name, args, fi, fo, lno, off):
+    def _call(self, name, args, lno, off):
         if not args:
             if name in self.environ:
-                fo.write(six.u(self.environ[name]))
-                return
-
-        if name in self.__locals:
-            f = self.__locals[name]
-        elif name in self.__globals:
-            f = self.__globals[name]
-        elif "." in name:
-            f = eval(name, self.__globals, self.__locals)
-        else:
-            f = None
+                return self.environ[name]
+
+        frame = self.__frame
+        scope = frame.scope
+        f = _chain_get(self.__locals if scope is None else scope, name)
+        if f is None:
+            f = _chain_get(self.__globals, name)
+            if f is None and "." in name:
+                f = self.eval(name)
 
         if f is None:
             self._error(NameError("name '%s' is not defined" % (name)), lno=lno)
@@ -291,9 +560,8 @@ class Smx:
 
         try:
             # these are available to the function, if needed
-
-            self.__func_lno = lno
-            self.__func_off = off
+            frame.func_lno = lno
+            frame.func_off = off
 
             if isinstance(f, dict):
                 if len(args) == 1:
@@ -301,93 +569,28 @@ class Smx:
                 else:
                     f[args[0]] = args[1]
                     res = None
+            elif type(f) is _Defined:
+                res = f(self, *args)
             elif not args and not callable(f):
                 res = str(f)
             else:
                 res = f(*args)
 
-            if res is not None:
-                fo.write(six.u(str(res)))
-            else:
-                log.debug("file %s, line %s, function %s returned None", self.__fi_name, lno, name)
+            if res is None:
+                log.debug("file %s, line %s, function %s returned None", frame.fi_name, lno, name)
+            return res
         except Exception as e:
-            log.debug("exception in file %s, line %s, function %s", self.__fi_name, lno, name)
+            log.debug("exception in file %s, line %s, function %s", self.__frame.fi_name, lno, name)
             self._error(e, lno=lno)
 
-    def scan_io(self, fi, fo, term, in_c = None):
-        c = in_c or fi.read(1)
-        res = u""
-        par = 0
-        while c != '':
-            # todo, properly generate a parse tree
-            if c == '\n':
-                self.__fi_lno += 1
-                self.__fi_off = 0
-            elif c == ' ':
-                self.__fi_off += 1
-            elif c == '(':
-                par += 1
-
-            if par:
-                if c in ')':
-                    par -= 1
-            elif c in term:
-                break
-
-            res += c
-            c = fi.read(1)
-        return c, res
-
-    def _exparg(self, fname, argnum, fi, no_expand=False):
-        c = fi.read(1)
-
-        while c.isspace():
-            c = fi.read(1)
-
-        fo = io.StringIO()
-      
-        if c == "'":
-            no_expand = True
-            c = fi.read(1)
-
-        if c in (')'):
-            return None, c
-
-        if c in (','):
-            return "", c
-
-        if no_expand:
-            if c == '"':
-                term_char, res = self.scan_io(fi, fo, term=['"'])
-            else:
-                term_char, res = self.scan_io(fi, fo, term=[',',')'], in_c=c)
-        else:
-            if c == '"':
-                term_char = self.expand_io(fi, fo, term=['"'])
-            else:
-                term_char = self.expand_io(fi, fo, term=[',',')'], in_c=c)
-
-        if term_char == '"':
-            c = fi.read(1)
-            while c.isspace():
-                c = fi.read(1)
-            term_char = c
-
-        if term_char not in [',', ')']:
-            self._error(SyntaxError("parsing argument %s in '%s'" % (argnum, fname)))
-
-        if no_expand:
-            return res, term_char
-
-        return str(fo.getvalue()), term_char
-
     def _error(self, e, lno=None):
         if not lno:
-            lno = self.__fi_lno
-        err = "file %s, line %s: %s(%s)" % (self.__fi_name, lno, e.__class__.__name__, str(e))
+            lno = self.__frame.fi_lno
+        file_name = self.__frame.fi_name
+        err = "file %s, line %s: %s(%s)" % (file_name, lno, e.__class__.__name__, str(e))
         log.error(err)
         e.line_number = lno
-        e.file_name = self.__fi_name
+        e.file_name = file_name
         raise e
 
 
@@ -495,6 +698,24 @@ def test_eval():
     ret = ctx.expand("%eval(2 ** 32)")
     assert ret == "4294967296"
 
+def test_code_cache():
+    ctx = Smx()
+    Smx.codes.clear()
+    ctx.expand("%eval(1 + 1)%python(y = 1)")
+    assert Smx.codes.misses == 3
+    # python tried eval, got a cached syntax error, then exec
+    Smx().expand("%eval(1 + 1)%python(y = 1)")
+    assert Smx.codes.hits == 3
+    assert Smx.codes.misses == 3
+
+def test_code_cache_bounded():
+    codes = CodeCache(maxsize=2)
+    for i in range(5):
+        codes.get(str(i), "eval")
+    assert len(codes) == 2
+    codes.get("4", "eval")
+    assert codes.hits == 1
+
 def test_err():
     ctx = Smx()
     try:
@@ -509,6 +730,164 @@ def test_for():
     assert res == "012345678"
 
 
+def test_for_body_parsed_once():
+    ctx = Smx()
+    tpl = ctx.compile("%for(x,range(3),%x%)")
+    body = tpl.nodes[0].args[2]
+    assert tpl.expand(ctx) == "012"
+    compiled = body.template
+    assert compiled is not None
+    assert tpl.expand(ctx) == "012"
+    assert body.template is compiled
+
+def test_for_streams():
+    ctx = Smx()
+    tpl = ctx.compile("<%for(x,range(20000),%x%)>")
+    pieces = list(tpl.iter_render(ctx))
+    assert len(pieces) > 3
+    assert max(len(p) for p in pieces) < STREAM_CHUNK * 2
+    assert "".join(pieces) == tpl.expand(ctx)
+
+def test_stream_error_lineno():
+    ctx = Smx()
+    tpl = ctx.compile("\n%for(x,range(3),%nope%)")
+    try:
+        list(tpl.iter_render(ctx))
+        assert False
+    except NameError as e:
+        assert e.line_number == 2
+
+def test_iter_expand():
+    ctx = Smx()
+    chunks = list(ctx.iter_expand('%for(x,range(100000),"%x%,")', chunk_size=1000))
+    assert len(chunks) > 10
+    assert all(len(c) == 1000 for c in chunks[:-1])
+    assert "".join(chunks) == "".join(str(x) + "," for x in range(100000))
+    assert list(ctx.iter_expand("")) == []
+
+def test_iter_expand_scope():
+    ctx = Smx()
+    chunks = ctx.iter_expand('%for(q,range(100000),"%q%,")')
+    assert next(chunks)
+    assert ctx.expand("%get(q)") == ""
+    rest = "".join(chunks)
+    assert rest.endswith("99999,")
+    assert ctx.expand("%get(q)") == ""
+
+def test_fork():
+    ctx = Smx()
+    ctx.expand("%set(x,1)%module(platform)")
+    child = ctx.fork()
+    assert child.expand("%x%") == "1"
+    assert child.expand("%platform.system%") == ctx.expand("%platform.system%")
+    child.expand("%set(x,2)%set(y,3)%define(d,D)")
+    assert child.expand("%x%%y%%d%") == "23D"
+    assert ctx.expand("%x%") == "1"
+    assert ctx.expand("%get(y)") == ""
+    try:
+        ctx.expand("%d%")
+        assert False
+    except NameError:
+        pass
+
+def test_fork_binds_macros_to_child():
+    ctx = Smx()
+    child = ctx.fork()
+    child.expand('%python("output(1)")')
+    child.expand('%python("x = 5")')
+    assert child.expand("%eval(x)") == "5"
+    assert ctx.expand("%get(x)") == ""
+
+def test_fork_define_in_parent():
+    ctx = Smx()
+    ctx.expand("%define(greet,hello %name%)")
+    child = ctx.fork()
+    child.set("name", "bob")
+    assert child.expand("%greet%") == "hello bob"
+    assert child.expand("%python(greet())") == "hello bob"
+
+def test_fork_binds_lazily():
+    ctx = Smx()
+    child = ctx.fork()
+    assert child.expand("%if(1,%python(add(1,1)),x)") == "2"
+    assert child.expand("%python(len([1, 1]))") == "2"
+    child.expand('%python("import json")')
+    bound = child._Smx__globals.maps[-1]._Macros__bound
+    assert sorted(bound) == ["add", "if", "python"]
+
+def test_subclass_macros():
+    class Sub(Smx):
+        @macro
+        def hello(self, x):
+            return "hi " + x
+
+    ctx = Sub()
+    assert ctx.expand("%hello(%add(1,1))") == "hi 2"
+    assert ctx.fork().expand("%hello(x)") == "hi x"
+
+def test_fork_subclass_attrs():
+    class Sub(Smx):
+        def __init__(self, prefix, **kws):
+            super().__init__(**kws)
+            self.prefix = prefix
+
+        @macro
+        def hello(self, x):
+            return self.prefix + x
+
+    ctx = Sub("hi ")
+    child = ctx.fork()
+    assert child.expand("%hello(x)") == "hi x"
+    child.prefix = "yo "
+    assert child.expand("%hello(x)") == "yo x"
+    assert ctx.expand("%hello(x)") == "hi x"
+
+def test_scopes():
+    ctx = Smx()
+    ctx.expand("%set(y,Y)")
+    assert ctx.expand("%for(x,range(2),%x%%y%)") == "0Y1Y"
+    assert ctx.expand("%for(i,range(2),%for(j,range(2),%i%%j%.))") == "00.01.10.11."
+    ctx.expand("%define(both,%a%%y%,a)")
+    assert ctx.expand("%both(A)") == "AY"
+
+    # loop variables and macro args don't leak out
+    assert ctx.expand("%get(x)%get(a)") == ""
+
+def test_scopes_popped():
+    ctx = Smx()
+    tpl = ctx.compile("%for(x,range(3),%x%)")
+    for i in range(100):
+        tpl.expand(ctx)
+    ctx.push_local({})
+    ctx.push_local({})
+    assert len(ctx._scope().maps) == 3
+    ctx.pop_local()
+    ctx.pop_local()
+    ctx.pop_local()
+    assert len(ctx._scope().maps) == 1
+    try:
+        ctx.expand("%for(x,range(3),%nope%)")
+    except NameError:
+        pass
+    assert len(ctx._scope().maps) == 1
+
+def test_threads():
+    from concurrent.futures import ThreadPoolExecutor
+
+    ctx = Smx()
+    ctx.expand("%set(base,B)")
+    tpl = ctx.compile("""%for(i,range(200),%for(j,range(3),
+        %indent(%i%.%j%%base%
+x)
+))""")
+    expected = tpl.expand(ctx)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: tpl.expand(ctx), range(32)))
+
+    assert all(r == expected for r in results)
+    assert len(ctx._scope().maps) == 1
+
 def test_define():
     ctx = Smx()
     
@@ -538,6 +917,53 @@ def test_defmacro():
     assert res == "6"
 
 
+def test_macro_cache():
+    calls = []
+
+    class Ctx(Smx):
+        @macro(cache=True, maxsize=2)
+        def lookup(self, name):
+            calls.append(name)
+            return name.upper()
+
+    ctx = Ctx()
+    assert ctx.expand("%lookup(a)%lookup(a)%lookup(b)") == "AAB"
+    assert Ctx().expand("%lookup(a)") == "A"
+    assert calls == ["a", "b"]
+    assert Ctx.lookup.cache.cache_info().hits == 2
+
+    assert Ctx.lookup.cache.get("a") == "A"
+    Ctx.lookup.cache.clear("a")
+    assert Ctx.lookup.cache.get("a") is None
+    Ctx.lookup.cache.set("c", _value="see")
+    assert ctx.expand("%lookup(c)%lookup(a)") == "seeA"
+    assert calls == ["a", "b", "a"]
+
+
+def test_cache_macro():
+    n = []
+
+    def bump():
+        n.append(1)
+        return len(n)
+
+    ctx = Smx({"bump": bump})
+    page = "%cache(side, 60, %bump%)"
+    assert ctx.expand(page) == "1"
+    assert ctx.expand(page) == "1"
+    # forks share the store of the context they came from
+    assert ctx.fork().expand(page) == "1"
+    assert Smx({"bump": bump}).expand(page) == "2"
+
+    assert ctx.expand("%cache(t, 0.01, %bump%)") == "3"
+    time.sleep(0.02)
+    assert ctx.expand("%cache(t, 0.01, %bump%)") == "4"
+
+    page = "%cache(g, 60, %bump%, process)"
+    assert ctx.expand(page) == "5"
+    assert Smx({"bump": bump}).expand(page) == "5"
+
+
 def test_set_get():
     ctx = Smx()
     ctx.expand("%python(x = 4)")
@@ -604,6 +1030,9 @@ def test_file():
     print(out.getvalue())
     assert str(out.getvalue()) == "012"
 
+    # iterator
+    assert "".join(Smx().iter_expand_file(f.name, chunk_size=1)) == "012"
+
     # inplace
     Smx().expand_file(f.name, in_place=True)
     res = str(open(f.name).read())
@@ -0,0 +1,428 @@
+"""Compiled smx templates
+
+A template is parsed once into a list of nodes: literal strings and macro
+calls.  Rendering walks the nodes, so the text is never re-scanned.
+"""
+
+import io
+import os
+import re
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Macro:
+    """A macro call: `%name%` or `%name(arg, ...)`
+
+    Each argument is either a `str` (quoted, or already fully literal) or a
+    `Template` that is expanded when the macro is called.
+    """
+
+    __slots__ = ("name", "args", "lno", "off")
+
+    def __init__(self, name, args, lno, off):
+        self.name = name
+        self.args = args
+        self.lno = lno
+        self.off = off
+
+    def render(self, ctx, fo):
+        args = [arg if isinstance(arg, str) else arg.expand(ctx) for arg in self.args]
+        ctx._exec(self.name, args, fo, self.lno, self.off)
+
+    def iter_render(self, ctx):
+        args = [arg if isinstance(arg, str) else arg.expand(ctx) for arg in self.args]
+        return ctx._iter_exec(self.name, args, self.lno, self.off)
+
+    def __repr__(self):
+        return "Macro(%r, %r)" % (self.name, self.args)
+
+
+class Source(str):
+    """Quoted macro argument, caches its compiled `Template`
+
+    Macros that expand a quoted body (like `for`) call `Smx.template()`,
+    which compiles the body on first use and keeps it here, so the body is
+    parsed once no matter how many times it runs.
+    """
+    template = None
+
+
+class Template:
+    """Parsed template, render with `render(ctx, out)`"""
+
+    __slots__ = ("nodes", "name")
+
+    def __init__(self, nodes, name="<inline>"):
+        self.nodes = nodes
+        self.name = name
+
+    def render(self, ctx, fo):
+        write = fo.write
+        for node in self.nodes:
+            if isinstance(node, str):
+                write(node)
+            else:
+                node.render(ctx, fo)
+
+    def iter_render(self, ctx):
+        """Render as a sequence of strings, without buffering the output
+
+        Macros that stream (like `for`) are yielded piece by piece.
+        """
+        for node in self.nodes:
+            if isinstance(node, str):
+                yield node
+            else:
+                yield from node.iter_render(ctx)
+
+    def expand(self, ctx):
+        fo = io.StringIO()
+        self.render(ctx, fo)
+        return fo.getvalue()
+
+    def __repr__(self):
+        return "Template(%r)" % (self.nodes,)
+
+
+def chunked(pieces, size):
+    """Join an iterable of strings into chunks of `size` chars
+
+    The last chunk may be shorter, empty chunks are never yielded.
+    """
+    buf = []
+    n = 0
+    for piece in pieces:
+        buf.append(piece)
+        n += len(piece)
+        if n >= size:
+            data = ''.join(buf)
+            for i in range(0, n - size + 1, size):
+                yield data[i:i + size]
+            rest = data[n - n % size:]
+            buf = [rest]
+            n = len(rest)
+    if n:
+        yield ''.join(buf)
+
+
+class FileCache:
+    """Process wide cache of template files, keyed by absolute path
+
+    Each entry keeps the file text, the templates compiled from it, and the
+    file's stat signature.  The file is stat'ed again at most once every
+    `check_secs`, and reloaded only if mtime, size or inode changed.
+    """
+
+    def __init__(self, check_secs=1.0):
+        self.check_secs = check_secs
+        self.__files = {}
+
+    def __entry(self, path):
+        path = os.path.abspath(path)
+        now = time.monotonic()
+        ent = self.__files.get(path)
+        if ent is not None and now < ent["checked"] + self.check_secs:
+            return ent
+
+        st = os.stat(path)
+        sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if ent is None or ent["sig"] != sig:
+            log.debug("load %s", path)
+            with open(path) as f:
+                ent = {"sig": sig, "text": f.read(), "templates": {}}
+            self.__files[path] = ent
+        ent["checked"] = now
+        return ent
+
+    def signature(self, path):
+        """(mtime_ns, size, inode) of the file at `path`, changes when it's modified"""
+        return self.__entry(path)["sig"]
+
+    def text(self, path):
+        """Contents of the file at `path`"""
+        return self.__entry(path)["text"]
+
+    def template(self, ctx, path):
+        """Template compiled from the file at `path`, for contexts like `ctx`"""
+        ent = self.__entry(path)
+        tpl = ent["templates"].get(ctx.__class__)
+        if tpl is None:
+            tpl = ent["templates"][ctx.__class__] = ctx.compile(ent["text"], name=path)
+        return tpl
+
+    def clear(self):
+        self.__files.clear()
+
+
+# parse_seq stops at '%', parens and the terminator, everything else is a literal run
+_SEQ = {term: re.compile("[%()" + re.escape("".join(term)) + "]") for term in [(), (',', ')'), ('"',)]}
+# scan only needs parens and the terminator
+_SCAN = {term: re.compile("[()" + re.escape("".join(term)) + "]") for term in [(',', ')'), ('"',)]}
+_NAME = re.compile(r"(?:[^\W_]|\.)*")
+_SPACE = re.compile(r"\s*")
+
+
+class Parser:
+    """Turns smx source text into a `Template`
+
+    `ctx` is used to look up which macro arguments are quoted, and to report
+    syntax errors.
+
+    The parser jumps between special characters with a regex, so literal runs
+    are sliced out in one piece.  Line number and offset (count of spaces
+    since the last newline) are computed lazily from the position.
+    """
+
+    def __init__(self, ctx, text, name="<inline>"):
+        self.ctx = ctx
+        self.text = text
+        self.name = name
+        self.pos = 0
+        self.__lno = 1
+        self.__off = 0
+        self.__lpos = 0
+
+    def parse(self):
+        nodes, _ = self.parse_seq(())
+        return Template(nodes, self.name)
+
+    def where(self):
+        """(line number, offset) of the current position"""
+        text, last, pos = self.text, self.__lpos, self.pos
+        nl = text.count('\n', last, pos)
+        if nl:
+            self.__lno += nl
+            self.__off = text.count(' ', text.rfind('\n', last, pos) + 1, pos)
+        else:
+            self.__off += text.count(' ', last, pos)
+        self.__lpos = pos
+        return self.__lno, self.__off
+
+    def _error(self, e):
+        self.ctx._error(e, lno=self.where()[0])
+
+    def parse_seq(self, term):
+        """Parse until an unbalanced char in `term`, returns (nodes, term_char)
+
+        Trailing spaces before the terminator are dropped.
+        """
+        search = _SEQ[term].search
+        text = self.text
+        nodes = []
+        buf = []
+        par = 0
+        pos = start = self.pos
+        while True:
+            m = search(text, pos)
+            if m is None:
+                end = pos = len(text)
+                c = ''
+                break
+
+            i = m.start()
+            c = text[i]
+            pos = i + 1
+
+            if c == '(':
+                par += 1
+                continue
+
+            if c in term and not par:
+                end = i
+                break
+
+            if c == ')':
+                par -= 1
+                continue
+
+            if c != '%':
+                continue
+
+            if text.startswith('%', pos):
+                buf.append(text[start:pos])
+                pos = start = pos + 1
+                continue
+
+            buf.append(text[start:i])
+            lit = ''.join(buf)
+            if lit:
+                nodes.append(lit)
+            buf = []
+
+            self.pos = pos
+            nodes.append(self.parse_macro())
+            pos = start = self.pos
+
+        buf.append(text[start:end])
+        lit = ''.join(buf).rstrip(' ')
+        if lit:
+            nodes.append(lit)
+        self.pos = pos
+        return nodes, c
+
+    def parse_macro(self):
+        text = self.text
+        m = _NAME.match(text, self.pos)
+        name = m.group()
+        self.pos = m.end()
+
+        f = self.ctx._lookup(name)
+        quoted = f and getattr(f, "quoted", None)
+
+        lno, off = self.where()
+        c = text[self.pos:self.pos + 1]
+        self.pos += 1
+        args = []
+        if c == '(':
+            anum = 1
+            arg, tc = self.parse_arg(name, anum, quoted and anum in quoted)
+            while arg is not None:
+                args.append(arg)
+                if tc != ',':
+                    break
+                anum += 1
+                arg, tc = self.parse_arg(name, anum, quoted and anum in quoted)
+        elif c != '%':
+            self._error(SyntaxError("unterminated macro"))
+
+        return Macro(name, args, lno, off)
+
+    def parse_arg(self, fname, argnum, no_expand=False):
+        text = self.text
+        self.pos = _SPACE.match(text, self.pos).end()
+
+        c = text[self.pos:self.pos + 1]
+        if c == "'":
+            no_expand = True
+            self.pos += 1
+            c = text[self.pos:self.pos + 1]
+
+        if c in (')'):
+            self.pos += 1
+            return None, c
+
+        if c in (','):
+            self.pos += 1
+            return "", c
+
+        if c == '"':
+            self.pos += 1
+            term = ('"',)
+        else:
+            term = (',', ')')
+
+        if no_expand:
+            res, term_char = self.scan(term)
+        else:
+            nodes, term_char = self.parse_seq(term)
+            if not nodes:
+                res = ""
+            elif len(nodes) == 1 and isinstance(nodes[0], str):
+                res = nodes[0]
+            else:
+                res = Template(nodes, self.name)
+
+        if term_char == '"':
+            self.pos = _SPACE.match(text, self.pos).end()
+            term_char = text[self.pos:self.pos + 1]
+            self.pos += 1
+
+        if term_char not in [',', ')']:
+            self._error(SyntaxError("parsing argument %s in '%s'" % (argnum, fname)))
+
+        return res, term_char
+
+    def scan(self, term):
+        """Collect raw text until an unbalanced char in `term`"""
+        search = _SCAN[term].search
+        text = self.text
+        par = 0
+        pos = start = self.pos
+        while True:
+            m = search(text, pos)
+            if m is None:
+                self.pos = len(text)
+                return Source(text[start:]), ''
+
+            i = m.start()
+            c = text[i]
+            pos = i + 1
+
+            if c == '(':
+                par += 1
+
+            if par:
+                if c == ')':
+                    par -= 1
+            elif c in term:
+                self.pos = pos
+                return Source(text[start:i]), c
+
+
+def test_parse_tree():
+    from .smx import Smx
+    tpl = Smx().compile("a %add(1,%x%) b")
+    assert tpl.nodes[0] == "a "
+    mac = tpl.nodes[1]
+    assert mac.name == "add"
+    assert mac.args[0] == "1"
+    assert isinstance(mac.args[1], Template)
+    assert tpl.nodes[2] == " b"
+
+
+def test_quoted_args_not_parsed():
+    from .smx import Smx
+    tpl = Smx().compile("%for(x,range(2),%x%)")
+    assert tpl.nodes[0].args == ["x", "range(2)", "%x%"]
+
+
+def test_render_many():
+    from .smx import Smx
+    ctx = Smx()
+    tpl = ctx.compile("%add(%n%,1)")
+    for i in range(3):
+        ctx.set("n", i)
+        assert tpl.expand(ctx) == str(i + 1)
+
+
+def test_line_numbers():
+    from .smx import Smx
+    tpl = Smx().compile("a\n  b %x%\n%y(1,\n  %z%)")
+    assert (tpl.nodes[1].lno, tpl.nodes[1].off) == (2, 3)
+    assert tpl.nodes[3].lno == 3
+    assert tpl.nodes[3].args[1].nodes[0].lno == 4
+
+
+def test_chunked():
+    assert list(chunked(["ab", "", "c", "def", "g"], 3)) == ["abc", "def", "g"]
+    assert list(chunked(["abcdefg", "h"], 3)) == ["abc", "def", "gh"]
+    assert list(chunked([""], 3)) == []
+
+
+def test_file_cache():
+    import tempfile
+    from .smx import Smx
+    ctx = Smx()
+    files = FileCache(check_secs=0)
+    with tempfile.NamedTemporaryFile("w", suffix=".smx", delete=False) as f:
+        f.write("%add(1,1)")
+    try:
+        tpl = files.template(ctx, f.name)
+        assert tpl.expand(ctx) == "2"
+        assert files.template(ctx, f.name) is tpl
+
+        with open(f.name, "w") as fo:
+            fo.write("%add(1,2)!")
+        assert files.text(f.name) == "%add(1,2)!"
+        assert files.template(ctx, f.name).expand(ctx) == "3!"
+
+        # not rechecked until check_secs has passed
+        files.check_secs = 60
+        with open(f.name, "w") as fo:
+            fo.write("changed")
+        assert files.text(f.name) == "%add(1,2)!"
+    finally:
+        os.unlink(f.name)
@@ -1,11 +1,16 @@
 import io
 import os
 import json
+import time
+import hashlib
+import mimetypes
 import traceback
 import logging
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import parse_qs
-from .smx import Smx
-from .memoize import memoize
+from .smx import Smx, STREAM_CHUNK
+from .template import chunked
+from .memoize import memoize, LRUCache
 
 log = logging.getLogger(__name__)
 
@@ -41,14 +46,173 @@ class RedirectError(HttpError):
 
 
 CHUNK = 1024*1024
+MAX_MEM_SIZE = 1024*1024
+# requests for more byte ranges than this get the whole file
+MAX_RANGES = 16
 
 
 def throw(err):
     raise err
 
 
+def _opaque_tag(tag):
+    # weak comparison, W/"x" matches "x"
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def not_modified(env, etag=None, mtime=None):
+    """True if the request's If-None-Match or If-Modified-Since shows the client's copy is current"""
+    if env.get("REQUEST_METHOD", "GET") not in ("GET", "HEAD"):
+        return False
+    if_none_match = env.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when If-None-Match is present
+        if etag is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or _opaque_tag(etag) in [_opaque_tag(tag) for tag in tags]
+    if_modified_since = env.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since and mtime is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def parse_ranges(header, size):
+    """[(first, last), ...] byte positions asked for by a Range header
+
+    Overlapping and adjacent ranges are merged, and ranges are sorted.
+    Returns [] if no range can be satisfied, and None if the header should be
+    ignored: malformed, not in bytes, or too many ranges after merging.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for part in spec.split(","):
+        first, dash, last = part.strip().partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash:
+            return None
+        if not first:
+            # suffix, the last n bytes
+            if not last.isdigit():
+                return None
+            n = int(last)
+            if n and size:
+                ranges.append((max(size - n, 0), size - 1))
+            continue
+        if not first.isdigit() or (last and not last.isdigit()):
+            return None
+        first = int(first)
+        if last:
+            if int(last) < first:
+                return None
+            last = min(int(last), size - 1)
+        else:
+            last = size - 1
+        if first < size:
+            ranges.append((first, last))
+    # so repeated or overlapping ranges can't make us send the same bytes many times
+    merged = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def _if_range(env, headers):
+    # Range applies if If-Range is missing, or matches the file's ETag (strongly) or Last-Modified
+    if_range = env.get("HTTP_IF_RANGE")
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == headers.get("ETag")
+    if if_range.startswith("W/"):
+        return False
+    return if_range == headers.get("Last-Modified")
+
+
+def _read_span(f, first, last):
+    f.seek(first)
+    remaining = last - first + 1
+    while remaining:
+        x = f.read(min(CHUNK, remaining))
+        if not x:
+            break
+        remaining -= len(x)
+        yield x
+
+
+class PageCache:
+    """Rendered pages, reused without running the interpreter
+
+    ttl: seconds a page is reused, 0 for no limit
+    vary: query string parameters that select a page, None for the whole query string
+    vary_headers: request headers that select a page, like "Accept-Language"
+    maxsize, maxbytes: bounds, least recently used pages are dropped first
+
+    Only complete 200 responses to GET and HEAD are stored, not streamed
+    ones, not those with a `Cache-Control` header of no-store, no-cache or
+    private, and not those that set a cookie.  Requests with an Authorization header are never cached, nor are
+    those with a Cookie header unless "Cookie" is in `vary_headers`.  A page
+    is rendered again when its file changes, but not when files it includes
+    change, so those wait for the ttl.
+    """
+
+    def __init__(self, ttl=60, vary=None, vary_headers=(), maxsize=1024, maxbytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.vary = vary
+        self.vary_headers = ["HTTP_" + h.upper().replace("-", "_") for h in vary_headers]
+        self.hits = 0
+        self.misses = 0
+        # values are (file signature, expiry time, headers, body)
+        self.pages = LRUCache(maxsize, maxbytes, sizeof=lambda entry: len(entry[3]))
+
+    def key(self, path, env):
+        """Cache key of the request for the page at `path`, None if it can't be cached"""
+        if env.get("REQUEST_METHOD", "GET") not in ("GET", "HEAD") or "HTTP_AUTHORIZATION" in env:
+            return None
+        # the page may read the session from cookies, so it's only shared when it's keyed by them
+        if "HTTP_COOKIE" in env and "HTTP_COOKIE" not in self.vary_headers:
+            return None
+        query = env.get("QUERY_STRING", "")
+        if self.vary is not None:
+            params = parse_qs(query)
+            query = tuple(tuple(params.get(name, ())) for name in self.vary)
+        return (path, query, tuple(env.get(h) for h in self.vary_headers))
+
+    def get(self, key, sig):
+        """(headers, body) stored for `key`, if it was rendered from the file with signature `sig`"""
+        entry = self.pages.get(key)
+        if entry is not None and entry[0] == sig and (entry[1] is None or time.monotonic() < entry[1]):
+            self.hits += 1
+            return entry[2], entry[3]
+        self.misses += 1
+        return None
+
+    def put(self, key, sig, headers, body):
+        cache_control = dict(headers).get("Cache-Control", "").lower()
+        if any(word in cache_control for word in ("no-store", "no-cache", "private")):
+            return
+        # a cookie set for one user must not be sent to the others
+        if any(name.lower() == "set-cookie" for name, _ in headers):
+            return
+        self.pages[key] = (sig, time.monotonic() + self.ttl if self.ttl else None, headers, body)
+
+    def clear(self):
+        self.pages.clear()
+
+
 class SmxWsgi:
-    def __init__(self, root=None, init=None):
+    def __init__(self, root=None, init=None, max_mem_size=MAX_MEM_SIZE, page_cache=None, etags=False):
         if not root:
             root = os.environ.get("SMX_ROOT")
         if not init:
@@ -58,6 +222,12 @@ class SmxWsgi:
         self.__expand = {".htx", ".smx"}
 
         self.root = root
+        # pages larger than this are streamed, None buffers the whole page
+        self.max_mem_size = max_mem_size
+        # PageCache, or None to render every request
+        self.page_cache = page_cache
+        # give buffered pages an ETag from a hash of their content
+        self.etags = etags
         self.ctx = Smx()
         if root:
             self.root = os.path.abspath(root)
@@ -68,7 +238,7 @@ class SmxWsgi:
 
         self._init = False
 
-    @memoize
+    @memoize(maxsize=4096)
     def is_script(self, path):
         _, ext = os.path.splitext(path)
 
@@ -78,16 +248,51 @@ class SmxWsgi:
                 return "%expand%" in x
         return ext in self.__expand
 
-    def static_resp(self, start_response, path):
-        content_type = "text/plain"
-        content_length = None
-
-        headers = []
-        headers.append(('Content-Type', content_type))
-        if content_length is not None:
-            headers.append(('Content-Length', str(content_length)))
+    @staticmethod
+    def static_headers(path, st):
+        """Content-Type, Content-Length and validators of a static file, from its stat"""
+        content_type, encoding = mimetypes.guess_type(path)
+        if encoding is not None:
+            # .gz and the like are sent as they are, not decoded by the client
+            content_type = "application/octet-stream"
+        return [('Content-Type', content_type or "text/plain"),
+                ('Content-Length', str(st.st_size)),
+                ('ETag', '"%x-%x"' % (st.st_mtime_ns, st.st_size)),
+                ('Last-Modified', formatdate(st.st_mtime, usegmt=True)),
+                ('Accept-Ranges', 'bytes')]
+
+    def static_file(self, env, start_response, path, file_wrapper):
+        """Response for a static file using the server's wsgi.file_wrapper, which can use sendfile"""
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            headers = self.static_headers(path, st)
+            if not_modified(env, headers[2][1], st.st_mtime):
+                f.close()
+                start_response('304 Not Modified', headers[2:])
+                return []
+            start_response('200 OK', headers)
+            return file_wrapper(f, CHUNK)
+        except BaseException:
+            f.close()
+            raise
 
+    def static_resp(self, start_response, path, env=None):
         with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            headers = self.static_headers(path, st)
+            if env is not None and not_modified(env, headers[2][1], st.st_mtime):
+                start_response('304 Not Modified', headers[2:])
+                return
+
+            ranges = None
+            if env is not None and "HTTP_RANGE" in env and env.get("REQUEST_METHOD", "GET") == "GET" \
+                    and _if_range(env, dict(headers)):
+                ranges = parse_ranges(env["HTTP_RANGE"], st.st_size)
+            if ranges is not None:
+                yield from self.range_resp(start_response, f, headers, ranges, st.st_size)
+                return
+
             x = f.read(CHUNK)
             start_response('200 OK', headers)
             while x:
@@ -95,7 +300,36 @@ class SmxWsgi:
                 yield x
                 x = f.read(CHUNK)
 
-    @memoize
+    def range_resp(self, start_response, f, headers, ranges, size):
+        """206 response with the byte `ranges` of the open file `f`, multipart if there are several"""
+        if not ranges:
+            start_response('416 Range Not Satisfiable', [('Content-Range', 'bytes */%d' % size), ('Content-Length', '0')])
+            return
+
+        content_type = headers[0][1]
+        validators = headers[2:]
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            start_response('206 Partial Content', [('Content-Type', content_type),
+                                                   ('Content-Length', str(last - first + 1)),
+                                                   ('Content-Range', 'bytes %d-%d/%d' % (first, last, size))] + validators)
+            yield from _read_span(f, first, last)
+            return
+
+        boundary = os.urandom(16).hex()
+        heads = [("--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n"
+                  % (boundary, content_type, first, last, size)).encode() for first, last in ranges]
+        end = ("--%s--\r\n" % boundary).encode()
+        length = sum(len(head) + last - first + 1 + 2 for head, (first, last) in zip(heads, ranges)) + len(end)
+        start_response('206 Partial Content', [('Content-Type', 'multipart/byteranges; boundary=' + boundary),
+                                               ('Content-Length', str(length))] + validators)
+        for head, (first, last) in zip(heads, ranges):
+            yield head
+            yield from _read_span(f, first, last)
+            yield b"\r\n"
+        yield end
+
+    @memoize(maxsize=4096)
     def find_index(self, dir):
         for f in ["index.smx", "index.html", "index.htm"]:
             p = os.path.join(dir, f)
@@ -103,37 +337,74 @@ class SmxWsgi:
                 return p
         return p
 
-    def __call__(self, env, start_response):
+    def resolve(self, env):
+        """(url, file path) of the request"""
+        url = env.get('SCRIPT_NAME')
+        if not url:
+            url = env.get('PATH_INFO', '/')
+
+        log.debug('%s', url)
+
+        url.replace("..", ".")
+
+        if url == "/":
+            full_path = self.root
+        else:
+            full_path = os.path.join(self.root, url.lstrip("/"))
 
+        if os.path.isdir(full_path):
+            full_path = self.find_index(full_path)
+
+        return url, full_path
+
+    def __call__(self, env, start_response):
         if not self._init:
             os.chdir(self.root)
             self._init = True
 
-        try:
-            url = env.get('SCRIPT_NAME')
-            if not url:
-                url = env.get('PATH_INFO', '/')
-
-            log.debug('%s', url)
+        file_wrapper = env.get('wsgi.file_wrapper')
+        # range requests read only the requested spans, below
+        if file_wrapper is not None and "HTTP_RANGE" not in env:
+            # static files are handed to the server, everything else, errors included, is served below
+            try:
+                url, full_path = self.resolve(env)
+                if not self.is_script(full_path):
+                    log.debug("STATIC %s", url)
+                    return self.static_file(env, start_response, full_path, file_wrapper)
+            except Exception:
+                pass
 
-            url.replace("..", ".")
+        return self.serve(env, start_response)
 
-            if url == "/":
-                full_path = self.root
-            else:
-                full_path = os.path.join(self.root, url.lstrip("/"))
+    def serve(self, env, start_response):
+        stream = None
 
-            if os.path.isdir(full_path):
-                full_path = self.find_index(full_path)
+        try:
+            url, full_path = self.resolve(env)
 
             try:
                 if not self.is_script(full_path):
                     log.debug("STATIC %s", url)
-                    yield from self.static_resp(start_response, full_path)
+                    yield from self.static_resp(start_response, full_path, env)
                     return
 
                 log.debug("SCRIPT %s", url)
 
+                page_key = None
+                if self.page_cache is not None:
+                    page_key = self.page_cache.key(full_path, env)
+                if page_key is not None:
+                    sig = Smx.files.signature(full_path)
+                    page = self.page_cache.get(page_key, sig)
+                    if page is not None:
+                        etag = dict(page[0]).get("ETag")
+                        if etag is not None and not_modified(env, etag):
+                            start_response('304 Not Modified', [('ETag', etag)])
+                            return
+                        start_response('200 OK', page[0])
+                        yield page[1]
+                        return
+
                 content = b"{}"
                 length = env.get("CONTENT_LENGTH", 0)
                 content_type = env.get('CONTENT_TYPE', "")
@@ -162,12 +433,7 @@ class SmxWsgi:
 
                 info.update(params)
 
-                # todo:
-                #   we process the first MAX_MEM_SIZE bytes for status codes & errors
-                #   if the file is larger than that
-                #   we STREAM the results
-
-                ctx = Smx(self.ctx, environ=env)
+                ctx = self.ctx.fork(environ=env)
 
                 headers = {}
 
@@ -177,15 +443,32 @@ class SmxWsgi:
                 ctx.set("error", lambda k, m=None, b=None: throw(HttpError(k, m, b)))
                 ctx.set("redirect", lambda k: throw(RedirectError(k)))
 
+                # we process the first max_mem_size chars for status codes, headers & errors
+                # if the page is larger than that, we STREAM the rest
                 fo = io.StringIO()
-                with open(full_path) as fi:
-                    ctx.expand_io(fi, fo)
+                pieces = Smx.files.template(ctx, full_path).iter_render(ctx)
+                for piece in pieces:
+                    fo.write(piece)
+                    if self.max_mem_size is not None and fo.tell() >= self.max_mem_size:
+                        stream = pieces
+                        break
 
                 response = fo.getvalue().encode("utf8")
-                headers.update({'Content-Type': content_type,
-                                "Content-Length": str(len(response))})
-                start_response('200 OK', [(k, v) for k, v in headers.items()])
-                yield bytes(fo.getvalue(), "utf8")
+                headers.update({'Content-Type': content_type})
+                if stream is None:
+                    headers["Content-Length"] = str(len(response))
+                    if self.etags and "ETag" not in headers:
+                        headers["ETag"] = '"%s"' % hashlib.blake2b(response, digest_size=16).hexdigest()
+                etag = headers.get("ETag") if stream is None else None
+                headers = [(k, v) for k, v in headers.items()]
+                if stream is None and page_key is not None:
+                    self.page_cache.put(page_key, sig, headers, response)
+                if etag is not None and not_modified(env, etag):
+                    start_response('304 Not Modified', [('ETag', etag)])
+                    return
+                start_response('200 OK', headers)
+                if stream is None:
+                    yield response
             except ConnectionAbortedError as e:
                 log.error("GET %s : ERROR : %s", url, e)
             except HttpError:
@@ -217,6 +500,19 @@ class SmxWsgi:
             start_response("500 Internal Error", [])
             yield bytes(traceback.format_exc(), "utf8")
 
+        if stream is not None:
+            # headers are sent, no Content-Length, so the server will chunk the body
+            # errors past this point can only abort the response
+            try:
+                yield response
+                for chunk in chunked(stream, STREAM_CHUNK):
+                    yield chunk.encode("utf8")
+            except ConnectionAbortedError as e:
+                log.error("GET %s : ERROR : %s", url, e)
+            except Exception:
+                log.exception("GET %s : ERROR after response started", url)
+                raise
+
 
 if __name__ == "__main__":
     main()
@@ -257,7 +553,7 @@ def app_fixture(test_env=False, with_init=None):
     else:
         app = SmxWsgi(root)
 
-    def req(url, post=b'', type=""):
+    def req(url, post=b'', type="", headers={}, env={}):
         temp = io.BytesIO(post)
         qs = ""
         split = url.split('?')
@@ -271,6 +567,9 @@ def app_fixture(test_env=False, with_init=None):
                 'CONTENT_TYPE': type,
                 'wsgi.input': temp,
                 }
+        for k, v in headers.items():
+            environ["HTTP_" + k.upper().replace("-", "_")] = v
+        environ.update(env)
 
         class resp:
             code = None
@@ -342,6 +641,181 @@ def test_static():
     assert res.code == 200
 
 
+def test_stream():
+    app = app_fixture()
+    app.max_mem_size = 100
+    app.create("hi.smx", "%for(x,range(100000),%x%)")
+    res = app.req("/hi.smx")
+    assert res.code == 200
+    assert "Content-Length" not in res.head
+    assert res.data == "".join(str(x) for x in range(100000)).encode()
+
+    app.create("small.smx", "%for(x,range(10),%x%)")
+    res = app.req("/small.smx")
+    assert res.head["Content-Length"] == "10"
+
+
+def test_stream_error_in_buffer():
+    app = app_fixture()
+    app.max_mem_size = 100
+    app.create("hi.smx", "some output %error(403, Forbidden)")
+    res = app.req("/hi.smx")
+    assert res.code == 403
+
+
+def test_page_cache():
+    app = app_fixture()
+    app.page_cache = PageCache(vary=["x"], vary_headers=["Accept-Language"])
+    app.create("hi.smx", "%python(n.append(1) or len(n))")
+    app.ctx.set("n", [])
+
+    assert app.req("/hi.smx?x=1").data == b"1"
+    assert app.req("/hi.smx?x=1&y=2").data == b"1"
+    assert app.req("/hi.smx?x=2").data == b"2"
+    assert app.req("/hi.smx?x=1", headers={"Accept-Language": "fr"}).data == b"3"
+    assert app.req("/hi.smx?x=1", post=b"a=1", type="application/x-www-form-urlencoded").data == b"4"
+    assert app.req("/hi.smx?x=1", headers={"Authorization": "Basic eA=="}).data == b"5"
+    assert app.req("/hi.smx?x=1", headers={"Cookie": "session=1"}).data == b"6"
+    assert app.req("/hi.smx?x=1", headers={"Cookie": "session=1"}).data == b"7"
+    assert app.page_cache.hits == 1
+
+    # changed files are rendered again
+    Smx.files.clear()
+    app.create("hi.smx", "%python(n.append(1) or -len(n))")
+    assert app.req("/hi.smx?x=1").data == b"-8"
+
+    app.create("private.smx", '%python(header["Cache-Control"] = "private")%python(n.append(1) or len(n))')
+    assert app.req("/private.smx").data == b"9"
+    assert app.req("/private.smx").data == b"10"
+    app.create("login.smx", '%python(header["Set-Cookie"] = "session=1")%python(n.append(1) or len(n))')
+    assert app.req("/login.smx").data == b"11"
+    assert app.req("/login.smx").data == b"12"
+
+    app.page_cache = PageCache(vary_headers=["Cookie"])
+    assert app.req("/hi.smx", headers={"Cookie": "session=1"}).data == b"-13"
+    assert app.req("/hi.smx", headers={"Cookie": "session=1"}).data == b"-13"
+    assert app.req("/hi.smx", headers={"Cookie": "session=2"}).data == b"-14"
+
+
+def test_static_file_wrapper():
+    import wsgiref.util
+    wrapped = []
+
+    def file_wrapper(f, size):
+        wrapped.append(f)
+        return wsgiref.util.FileWrapper(f, size)
+
+    app = app_fixture()
+    app.create("app.js", "var x;")
+    app.create("hi.smx", "%add(1,1)")
+    res = app.req("/app.js", env={"wsgi.file_wrapper": file_wrapper})
+    assert res.data == b"var x;"
+    assert res.head["Content-Length"] == "6"
+    assert res.head["Content-Type"] in ("application/javascript", "text/javascript")
+    assert len(wrapped) == 1
+
+    res = app.req("/app.js", env={"wsgi.file_wrapper": file_wrapper}, headers={"If-None-Match": res.head["ETag"]})
+    assert (res.code, res.data) == (304, b"")
+
+    assert app.req("/hi.smx", env={"wsgi.file_wrapper": file_wrapper}).data == b"2"
+    assert app.req("/nope.js", env={"wsgi.file_wrapper": file_wrapper}).code == 404
+    assert len(wrapped) == 1
+
+    # errors are reported by the app, not raised to the server
+    with open(os.path.join(app.root, "latin.html"), "wb") as f:
+        f.write(b"caf\xe9")
+    res = app.req("/latin.html", env={"wsgi.file_wrapper": file_wrapper})
+    assert res.code == app.req("/latin.html").code
+
+
+def test_parse_ranges():
+    assert parse_ranges("bytes=0-4", 10) == [(0, 4)]
+    assert parse_ranges("bytes=5-, -3", 10) == [(5, 9)]
+    assert parse_ranges("bytes=6-7, 0-1, 2-3", 10) == [(0, 3), (6, 7)]
+    assert parse_ranges("bytes=" + ",".join(["0-"] * 100), 10) == [(0, 9)]
+    assert parse_ranges("bytes=8-20", 10) == [(8, 9)]
+    assert parse_ranges("bytes=10-", 10) == []
+    assert parse_ranges("bytes=-0", 10) == []
+    assert parse_ranges("bytes=4-2", 10) is None
+    assert parse_ranges("bytes=x-2", 10) is None
+    assert parse_ranges("lines=1-2", 10) is None
+    assert parse_ranges("bytes=" + ",".join("%d-%d" % (i * 2, i * 2) for i in range(MAX_RANGES + 1)), 100) is None
+
+
+def test_static_range():
+    app = app_fixture()
+    app.create("a.bin", bytes(range(100)))
+    res = app.req("/a.bin")
+    assert res.head["Accept-Ranges"] == "bytes"
+    etag = res.head["ETag"]
+
+    res = app.req("/a.bin", headers={"Range": "bytes=10-19"})
+    assert (res.code, res.data) == (206, bytes(range(10, 20)))
+    assert res.head["Content-Range"] == "bytes 10-19/100"
+    assert res.head["Content-Length"] == "10"
+
+    res = app.req("/a.bin", headers={"Range": "bytes=0-1,-2"})
+    assert res.code == 206
+    boundary = res.head["Content-Type"].split("boundary=")[1]
+    assert len(res.data) == int(res.head["Content-Length"])
+    parts = res.data.split(b"--" + boundary.encode())
+    assert parts[1].endswith(b"\r\n\r\n\x00\x01\r\n")
+    assert b"Content-Range: bytes 98-99/100" in parts[2] and parts[2].endswith(b"\x62\x63\r\n")
+    assert parts[3] == b"--\r\n"
+
+    res = app.req("/a.bin", headers={"Range": "bytes=200-"})
+    assert res.code == 416
+    assert res.head["Content-Range"] == "bytes */100"
+
+    # If-Range must match, or the whole file is sent
+    res = app.req("/a.bin", headers={"Range": "bytes=0-0", "If-Range": etag})
+    assert (res.code, res.data) == (206, b"\x00")
+    res = app.req("/a.bin", headers={"Range": "bytes=0-0", "If-Range": '"old"'})
+    assert (res.code, len(res.data)) == (200, 100)
+
+    # the file wrapper isn't used for ranges
+    res = app.req("/a.bin", headers={"Range": "bytes=99-"}, env={"wsgi.file_wrapper": lambda f, size: throw(AssertionError("file wrapper used"))})
+    assert (res.code, res.data) == (206, b"\x63")
+
+
+def test_static_not_modified():
+    app = app_fixture()
+    app.create("hi.txt", "hello")
+    res = app.req("/hi.txt")
+    etag, modified = res.head["ETag"], res.head["Last-Modified"]
+    assert res.data == b"hello"
+
+    res = app.req("/hi.txt", headers={"If-None-Match": 'W/"x", ' + etag})
+    assert (res.code, res.data) == (304, b"")
+    assert res.head["ETag"] == etag
+    res = app.req("/hi.txt", headers={"If-Modified-Since": modified})
+    assert (res.code, res.data) == (304, b"")
+    # If-None-Match wins over If-Modified-Since
+    res = app.req("/hi.txt", headers={"If-None-Match": '"other"', "If-Modified-Since": modified})
+    assert res.code == 200
+
+    os.utime(os.path.join(app.root, "hi.txt"), (1, 1))
+    res = app.req("/hi.txt", headers={"If-None-Match": etag})
+    assert (res.code, res.data) == (200, b"hello")
+
+
+def test_page_etag():
+    app = app_fixture()
+    app.create("hi.smx", "%add(1,1)")
+    assert "ETag" not in app.req("/hi.smx").head
+
+    app.etags = True
+    etag = app.req("/hi.smx").head["ETag"]
+    res = app.req("/hi.smx", headers={"If-None-Match": etag})
+    assert (res.code, res.data) == (304, b"")
+
+    app.page_cache = PageCache()
+    assert app.req("/hi.smx").head["ETag"] == etag
+    res = app.req("/hi.smx", headers={"If-None-Match": etag})
+    assert (res.code, res.data) == (304, b"")
+    assert app.page_cache.hits == 1
+
+
 def test_init():
     app = app_fixture(with_init='%set(foo, 44)')
     app.create("hi.smx", "%add(2,%foo%)")
@@ -349,6 +823,12 @@ def test_init():
     assert b'46' == res.data
     assert res.code == 200
 
+def test_init_define():
+    app = app_fixture(with_init='%define(greet,hello %form(name))')
+    app.create("hi.smx", "%greet%")
+    res = app.req("/hi.smx?name=bob")
+    assert (res.code, res.data) == (200, b"hello bob")
+
 def test_index():
     app = app_fixture(test_env=True)
     app.create("index.smx", "%add(1,1)")